@@ -0,0 +1,117 @@
+import argparse
+import string
+import time
+
+import numpy as np
+
+BYTE_FEATURE_NAMES = ['punctuation_rate', 'uppercase_ratio', 'digit_ratio', 'mean_whitespace_run',
+                      'long_whitespace_run_rate', 'byte_avg_word_length']
+
+
+def _byte_class(characters):
+    table = np.zeros(256, dtype=bool)
+    table[list(characters.encode('ascii'))] = True
+    return table
+
+
+_PUNCTUATION = _byte_class(string.punctuation)
+_WHITESPACE = _byte_class(string.whitespace)
+_UPPERCASE = _byte_class(string.ascii_uppercase)
+_LETTER = _byte_class(string.ascii_letters)
+_DIGIT = _byte_class(string.digits)
+
+
+def _segment_sums(values, starts, lengths):
+    """Sum of values over each document's byte range; empty documents sum to 0"""
+    sums = np.zeros(len(starts), dtype=values.dtype)
+    # reduceat only over non-empty documents: their starts are strictly increasing and in range
+    non_empty = lengths > 0
+    if non_empty.any():
+        sums[non_empty] = np.add.reduceat(values, starts[non_empty])
+    return sums
+
+
+def byte_feature_matrix(texts):
+    """
+        BYTE_FEATURE_NAMES for many texts at once, shape (len(texts), 6). The texts are UTF-8 encoded
+        into one buffer viewed as uint8 with np.frombuffer, classified with 256-entry lookup tables
+        and reduced per document, so there is no Python loop over characters. Classes are ASCII;
+        multi-byte characters count as non-whitespace bytes of no class
+    """
+    encoded = [text.encode('utf-8') for text in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    whitespace = _WHITESPACE[data]
+    document_start = np.zeros(len(data), dtype=bool)
+    document_start[starts[lengths > 0]] = True
+    previous_whitespace = np.empty(len(data), dtype=bool)
+    if len(data):
+        previous_whitespace[0] = False
+        previous_whitespace[1:] = whitespace[:-1]
+    # A run starts at the first byte of a document or where the byte class changes
+    run_start = document_start | (whitespace != previous_whitespace)
+    whitespace_runs = run_start & whitespace
+    word_starts = run_start & ~whitespace
+
+    # Lengths of whitespace runs, to count those longer than one byte (double spaces, blank lines)
+    run_ids = np.cumsum(run_start) - 1
+    run_lengths = np.bincount(run_ids, minlength=int(run_ids[-1]) + 1 if len(data) else 0)
+    long_run = np.zeros(len(data), dtype=bool)
+    long_run[np.flatnonzero(whitespace_runs)] = run_lengths[run_ids[whitespace_runs]] > 1
+
+    counts = {name: _segment_sums(values.astype(np.int64), starts, lengths) for name, values in [
+        ('punctuation', _PUNCTUATION[data]), ('uppercase', _UPPERCASE[data]), ('letters', _LETTER[data]),
+        ('digits', _DIGIT[data]), ('whitespace', whitespace), ('whitespace_runs', whitespace_runs),
+        ('long_runs', long_run), ('words', word_starts)]}
+    visible = lengths - counts['whitespace']
+
+    def ratio(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros(len(texts)), where=denominator > 0)
+
+    return np.column_stack([
+        ratio(counts['punctuation'], visible),
+        ratio(counts['uppercase'], counts['letters']),
+        ratio(counts['digits'], visible),
+        ratio(counts['whitespace'], counts['whitespace_runs']),
+        ratio(counts['long_runs'], counts['whitespace_runs']),
+        ratio(visible, counts['words']),
+    ])
+
+
+def byte_features(text):
+    """BYTE_FEATURE_NAMES of a single text, for the get_text_features block"""
+    return byte_feature_matrix([text])[0].tolist()
+
+
+def check_batch_consistency(texts):
+    """Raise if scoring texts as one batch, with empty texts at the start, middle and end, differs from one by one"""
+    middle = len(texts) // 2
+    batch = ['', ''] + list(texts[:middle]) + ['', ''] + list(texts[middle:]) + ['', '']
+    single = np.array([byte_features(text) for text in batch])
+    mismatched = np.flatnonzero(~np.isclose(byte_feature_matrix(batch), single).all(axis=1))
+    if len(mismatched):
+        raise ValueError(f"batched byte features differ from single-text ones at rows {mismatched.tolist()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time byte-level features against the token-based ones")
+    parser.add_argument("directories", nargs='+')
+    args = parser.parse_args()
+
+    import main as aux_function
+    from token_cache import read_corpus
+
+    texts = read_corpus(args.directories)
+    check_batch_consistency(texts)
+    start = time.perf_counter()
+    byte_feature_matrix(texts)
+    byte_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for text in texts:
+        aux_function.get_cheap_text_features(text)
+    token_seconds = time.perf_counter() - start
+    print(f"{len(texts)} documents: byte features {byte_seconds * 1000:.1f} ms, token-based cheap features "
+          f"{token_seconds * 1000:.1f} ms ({token_seconds / byte_seconds:.0f}x)")
@@ -0,0 +1,182 @@
+import argparse
+import hashlib
+import os
+import re
+import zlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+EXACT = 'exact'
+NEAR = 'near'
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_word_re = re.compile(r'\w+')
+
+DuplicateMatch = namedtuple('DuplicateMatch', ['kind', 'key', 'similarity'])
+NO_MATCH = DuplicateMatch(None, None, 0.0)
+
+
+def shingles(text, size=5):
+    """Set of lowercase word `size`-grams; whitespace, case and punctuation edits do not change it"""
+    words = _word_re.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class DedupIndex:
+    """
+        MinHash/LSH index of ingested documents. Detects exact duplicates by content hash and
+        near duplicates by estimated Jaccard similarity of their shingles, and keeps at most
+        max_documents entries (least recently seen are evicted)
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=16, shingle_size=5, max_documents=100000, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_documents = max_documents
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_MERSENNE_PRIME), num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_MERSENNE_PRIME), num_perm, dtype=np.uint64)
+
+        self._documents = OrderedDict()  # key -> (digest, signature)
+        self._digests = {}  # digest -> key
+        self._buckets = [{} for _ in range(bands)]  # band hash -> set of keys
+        self._results = {}
+        self.stats = {'documents': 0, 'exact_duplicates': 0, 'near_duplicates': 0, 'unique': 0, 'evicted': 0}
+
+    def signature(self, text):
+        """MinHash signature of the text's shingles; None when it is too short to have any"""
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text, self.shingle_size)],
+                          dtype=np.uint64)
+        if not len(hashes):
+            return None
+        # Universal hashing a*x+b (wrapping in 64 bits, as datasketch does), one row per permutation
+        permuted = np.bitwise_and((np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME, _MAX_HASH)
+        return permuted.min(axis=0)
+
+    def _band_hashes(self, signature):
+        return [hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _lookup(self, digest, signature):
+        key = self._digests.get(digest)
+        if key is not None:
+            return DuplicateMatch(EXACT, key, 1.0)
+        # Texts without shingles would all share one empty signature; only their content hash is compared
+        if signature is None:
+            return NO_MATCH
+
+        candidates = set()
+        for band, band_hash in enumerate(self._band_hashes(signature)):
+            candidates.update(self._buckets[band].get(band_hash, ()))
+
+        best = NO_MATCH
+        for candidate in candidates:
+            similarity = float(np.mean(self._documents[candidate][1] == signature))
+            if similarity >= self.threshold and similarity > best.similarity:
+                best = DuplicateMatch(NEAR, candidate, similarity)
+        return best
+
+    def query(self, text):
+        """Find an exact or near duplicate of text without adding it"""
+        return self._lookup(hashlib.sha1(text.encode('utf-8')).hexdigest(), self.signature(text))
+
+    def check(self, key, text):
+        """Look text up, record the outcome in the stats and add it to the index under key"""
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        signature = self.signature(text)
+        match = self._lookup(digest, signature)
+
+        self.stats['documents'] += 1
+        if match.kind == EXACT:
+            self.stats['exact_duplicates'] += 1
+            # Nothing new to index; just mark the original as recently seen
+            self._documents.move_to_end(match.key)
+            return match
+        self.stats['near_duplicates' if match.kind == NEAR else 'unique'] += 1
+
+        self._add(key, digest, signature)
+        return match
+
+    def _add(self, key, digest, signature):
+        if key in self._documents:
+            self._remove(key)
+        self._documents[key] = (digest, signature)
+        self._digests[digest] = key
+        if signature is not None:
+            for band, band_hash in enumerate(self._band_hashes(signature)):
+                self._buckets[band].setdefault(band_hash, set()).add(key)
+
+        while len(self._documents) > self.max_documents:
+            self._remove(next(iter(self._documents)))
+            self.stats['evicted'] += 1
+
+    def _remove(self, key):
+        digest, signature = self._documents.pop(key)
+        if self._digests.get(digest) == key:
+            del self._digests[digest]
+        for band, band_hash in enumerate(self._band_hashes(signature) if signature is not None else []):
+            bucket = self._buckets[band][band_hash]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[band][band_hash]
+        self._results.pop(key, None)
+
+    def set_result(self, key, result):
+        """Remember the result computed for key so exact duplicates can reuse it"""
+        if key in self._documents:
+            self._results[key] = result
+
+    def get_result(self, key):
+        return self._results.get(key)
+
+    def report(self):
+        stats = self.stats
+        duplicates = stats['exact_duplicates'] + stats['near_duplicates']
+        rate = duplicates / stats['documents'] if stats['documents'] else 0
+        print(f"Deduplication: {stats['documents']} documents, {stats['unique']} unique, "
+              f"{stats['exact_duplicates']} exact and {stats['near_duplicates']} near duplicates "
+              f"({rate:.1%}), {stats['evicted']} evicted, {len(self._documents)} indexed")
+
+
+def dedupe_files(file_paths, index=None):
+    """
+        Split file paths into the ones to keep and (path, DuplicateMatch) pairs for exact or near
+        copies of a file seen earlier, so training data does not overweight resubmitted texts
+    """
+    if index is None:
+        index = DedupIndex()
+    kept = []
+    duplicates = []
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+            match = index.check(file_path, file.read())
+        if match.kind is None:
+            kept.append(file_path)
+        else:
+            duplicates.append((file_path, match))
+    return kept, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report exact and near duplicate documents across directories")
+    parser.add_argument("directories", nargs='+')
+    parser.add_argument("--threshold", type=float, default=0.8)
+    args = parser.parse_args()
+
+    paths = [os.path.join(directory, filename)
+             for directory in args.directories
+             for filename in sorted(os.listdir(directory))
+             if os.path.isfile(os.path.join(directory, filename)) and not filename.startswith('.')]
+    dedup_index = DedupIndex(threshold=args.threshold)
+    _, duplicate_files = dedupe_files(paths, dedup_index)
+    for path, duplicate in duplicate_files:
+        print(f"{path}\t{duplicate.kind} duplicate of {duplicate.key}\t{duplicate.similarity:.2f}")
+    dedup_index.report()
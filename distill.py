@@ -0,0 +1,170 @@
+import argparse
+import os
+import pickle
+import re
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix, hstack
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+
+LEXICAL_FEATURE_NAMES = ['avg_word_length', 'type_token_ratio', 'avg_sentence_length', 'punctuation_rate']
+
+_word_re = re.compile(r'\w+')
+_sentence_end_re = re.compile(r'[.!?]+')
+_punctuation_re = re.compile(r'[^\w\s]')
+
+
+def lexical_features(text):
+    """Regex-only lexical statistics, no NLTK tokenization"""
+    words = _word_re.findall(text.lower())
+    if not words:
+        return [0, 0, 0, 0]
+    sentences = max(1, len(_sentence_end_re.findall(text)))
+    return [
+        sum(len(word) for word in words) / len(words),
+        len(set(words)) / len(words),
+        len(words) / sentences,
+        len(_punctuation_re.findall(text)) / len(text),
+    ]
+
+
+class StudentModel:
+    """
+        Fast AI-text classifier trained to imitate the GPT-2 based teacher: hashed word n-grams
+        (optionally character n-grams too) plus cheap lexical features, fed to a logistic regression.
+        Character n-gram hashing costs about four times the word block, so it is off by default
+    """
+
+    def __init__(self, n_features=2 ** 18, char_ngrams=False):
+        self.vectorizers = [('word_ngrams', HashingVectorizer(ngram_range=(1, 2), n_features=n_features,
+                                                              alternate_sign=False, norm='l2'))]
+        if char_ngrams:
+            self.vectorizers.append(('char_ngrams', HashingVectorizer(analyzer='char_wb', ngram_range=(3, 5),
+                                                                      n_features=n_features, alternate_sign=False,
+                                                                      norm='l2')))
+        self.model = LogisticRegression(max_iter=1000, C=10)
+        self.n_features = n_features
+
+    @property
+    def feature_groups(self):
+        return [name for name, _ in self.vectorizers] + LEXICAL_FEATURE_NAMES
+
+    def transform(self, texts):
+        lexical = np.array([lexical_features(text) for text in texts], dtype=np.float64)
+        blocks = [vectorizer.transform(texts) for _, vectorizer in self.vectorizers]
+        return hstack(blocks + [csr_matrix(lexical)], format='csr')
+
+    def fit(self, texts, teacher_labels):
+        self.model.fit(self.transform(texts), teacher_labels)
+        return self
+
+    def predict_proba(self, texts):
+        return self.model.predict_proba(self.transform(texts))[:, 1]
+
+    def group_contributions(self, text):
+        """Contribution of each feature group (coefficient x value), like main.analyze_feature_importance"""
+        x = self.transform([text])
+        contributions = x.multiply(self.model.coef_[0]).toarray()[0]
+        hashed_width = len(self.vectorizers) * self.n_features
+        grouped = [contributions[start:start + self.n_features].sum()
+                   for start in range(0, hashed_width, self.n_features)]
+        feature_contributions = list(zip(self.feature_groups, grouped + list(contributions[hashed_width:])))
+        feature_contributions.sort(key=lambda x: abs(x[1]), reverse=True)
+        return feature_contributions
+
+
+def classify_text_fast(text, student):
+    """Same return value as main.classify_text, without a GPT-2 forward pass"""
+    probability = student.predict_proba([text])[0]
+    prediction_label = "AI-generated" if probability >= 0.5 else "Human-written"
+
+    feature_contributions = student.group_contributions(text)
+    total_contribution = sum(abs(contrib) for _, contrib in feature_contributions) or 1
+    interpreted_contributions = []
+    for feature, contribution in feature_contributions:
+        if (prediction_label == "AI-generated" and contribution > 0) or \
+                (prediction_label == "Human-written" and contribution < 0):
+            direction = "towards this prediction"
+        else:
+            direction = "against this prediction"
+        interpreted_contributions.append((feature, abs(contribution / total_contribution) * 100, direction))
+    return prediction_label, probability, interpreted_contributions
+
+
+def label_with_teacher(texts, teacher_filename):
+    """AI probabilities of the full GPT-2 feature model for every text"""
+    import main as aux_function
+
+    teacher, feature_names = aux_function.load_model(teacher_filename)
+    probabilities = []
+    for i, text in enumerate(texts):
+        _, probability, _ = aux_function.classify_text(text, teacher, feature_names)
+        probabilities.append(probability)
+        if (i + 1) % 100 == 0:
+            print(f"Teacher labelled {i + 1}/{len(texts)} documents")
+    return np.array(probabilities)
+
+
+def distill(texts, teacher_filename, student_filename, test_size=0.2, char_ngrams=False):
+    """Label texts with the teacher, train a student on them and report agreement and throughput"""
+    teacher_probabilities = label_with_teacher(texts, teacher_filename)
+    teacher_labels = (teacher_probabilities >= 0.5).astype(int)
+
+    train_texts, test_texts, train_labels, test_labels, _, test_probabilities = train_test_split(
+        texts, teacher_labels, teacher_probabilities, test_size=test_size, random_state=42)
+
+    student = StudentModel(char_ngrams=char_ngrams).fit(train_texts, train_labels)
+
+    start = time.perf_counter()
+    student_probabilities = student.predict_proba(test_texts)
+    elapsed = time.perf_counter() - start
+
+    agreement = np.mean((student_probabilities >= 0.5).astype(int) == test_labels)
+    print("\nStudent vs. Teacher:")
+    print(f"Agreement: {agreement:.4f}")
+    print(f"Mean absolute probability difference: {np.mean(np.abs(student_probabilities - test_probabilities)):.4f}")
+    print(f"Throughput: {len(test_texts) / elapsed:.0f} documents/s")
+
+    with open(student_filename, 'wb') as file:
+        pickle.dump((student, student.feature_groups), file)
+    print(f"\nStudent model saved to {student_filename}")
+    return student
+
+
+def load_student(filename):
+    with open(filename, 'rb') as file:
+        student, _ = pickle.load(file)
+    return student
+
+
+def read_unlabeled(directories):
+    texts = []
+    for directory in directories:
+        for root, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith('.txt'):
+                    with open(os.path.join(root, filename), 'r', encoding='utf-8', errors='ignore') as file:
+                        texts.append(file.read())
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distil the GPT-2 feature model into a fast student model")
+    parser.add_argument("directories", nargs='+', help="unlabeled corpus directories (searched recursively)")
+    parser.add_argument("--teacher", default="ai_detection_model.pkl")
+    parser.add_argument("--student", default="student_model.pkl")
+    parser.add_argument("--char-ngrams", action="store_true", help="add hashed character n-grams (slower)")
+    args = parser.parse_args()
+
+    # Throughput is measured on a single core
+    from execution import apply_thread_limits
+    apply_thread_limits(1)
+    # Train through the imported module, so the pickle refers to distill.StudentModel rather than
+    # __main__.StudentModel, which load_student could not resolve from any other script
+    import distill as distill_module
+
+    distill_module.distill(read_unlabeled(args.directories), args.teacher, args.student,
+                           char_ngrams=args.char_ngrams)
@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing import Process
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+DEFAULT_PORT = 6000
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+MAX_ATTEMPTS = 3
+# Messages are pickles, so only peers holding this shared secret may connect
+AUTHKEY_ENV = "AI_DETECTION_AUTHKEY"
+
+
+def _authkey():
+    key = os.getenv(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(f"Set {AUTHKEY_ENV} to the same secret on the coordinator and every worker")
+    return key.encode('utf-8')
+
+
+class Coordinator:
+    """
+        Splits a corpus into shards and hands them to workers connecting over TCP. A shard
+        whose worker disconnects or stays silent for heartbeat_timeout seconds is given to
+        another worker; results are merged back in input order
+    """
+
+    def __init__(self, texts, shard_size=16, address=('127.0.0.1', DEFAULT_PORT), heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, authkey=None):
+        self.shards = [texts[start:start + shard_size] for start in range(0, len(texts), shard_size)]
+        self.address = address
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.authkey = authkey
+
+        self._pending = deque(range(len(self.shards)))
+        self._attempts = [0] * len(self.shards)
+        self._results = {}
+        self._condition = threading.Condition()
+        self._listener = None
+
+    def _all_done(self):
+        return len(self._results) == len(self.shards)
+
+    def _next_shard(self):
+        """Next shard to hand out, waiting while others are in flight; None once every shard is done"""
+        with self._condition:
+            while not self._pending and not self._all_done():
+                self._condition.wait(1)
+            if self._all_done():
+                return None
+            shard_id = self._pending.popleft()
+            self._attempts[shard_id] += 1
+            return shard_id
+
+    def _complete(self, shard_id, results):
+        with self._condition:
+            # A late result from a worker we already gave up on may arrive after the retry finished
+            if shard_id not in self._results:
+                self._results[shard_id] = results
+                print(f"Shard {shard_id + 1}/{len(self.shards)} done ({len(self._results)} complete)")
+            self._condition.notify_all()
+
+    def _retry(self, shard_id, reason):
+        with self._condition:
+            if shard_id in self._results:
+                return
+            if self._attempts[shard_id] >= self.max_attempts:
+                print(f"Shard {shard_id} failed {self._attempts[shard_id]} times ({reason}), giving up on it")
+                self._results[shard_id] = [None] * len(self.shards[shard_id])
+            else:
+                print(f"Reassigning shard {shard_id}: {reason}")
+                self._pending.appendleft(shard_id)
+            self._condition.notify_all()
+
+    def _serve(self, connection, worker):
+        try:
+            while True:
+                shard_id = self._next_shard()
+                if shard_id is None:
+                    connection.send(('stop',))
+                    return
+                try:
+                    connection.send(('shard', shard_id, self.shards[shard_id]))
+                    while True:
+                        if not connection.poll(self.heartbeat_timeout):
+                            raise TimeoutError(f"no heartbeat from {worker} for {self.heartbeat_timeout}s")
+                        message = connection.recv()
+                        if message[0] == 'result':
+                            self._complete(shard_id, message[2])
+                            break
+                        if message[0] == 'error':
+                            self._retry(shard_id, f"{worker} raised {message[2]}")
+                            break
+                except (EOFError, OSError, TimeoutError) as e:
+                    self._retry(shard_id, f"lost {worker}: {str(e) or type(e).__name__}")
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError):
+                if self._listener is None:
+                    return
+                continue
+            # The handshake runs on the connection's own thread, so a silent client can't hold up the others
+            threading.Thread(target=self._handshake, args=(connection,), daemon=True).start()
+
+    def _handshake(self, connection):
+        """Authenticate the client and read its hello within heartbeat_timeout, then serve it shards"""
+        # Shutting the socket down wakes a recv blocked on a client that never answers
+        watchdog = threading.Timer(self.heartbeat_timeout, _shutdown, args=(connection,))
+        watchdog.start()
+        try:
+            deliver_challenge(connection, self._key)
+            answer_challenge(connection, self._key)
+            kind, worker = connection.recv()
+            if kind != 'hello':
+                raise ValueError(f"expected hello, got {kind!r}")
+        except Exception as e:
+            # Wrong key, a broken handshake or no answer before the deadline: drop just this client
+            print(f"Rejected connection: {e!r}")
+            connection.close()
+            return
+        finally:
+            watchdog.cancel()
+        print(f"Worker {worker} connected")
+        self._serve(connection, worker)
+
+    def start(self):
+        self._key = self.authkey or _authkey()
+        # No authkey on the Listener itself: its accept() would run the handshake on the accept thread
+        self._listener = Listener(self.address)
+        self.address = self._listener.address
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.address
+
+    def wait(self, timeout=None):
+        """
+            Block until every shard is done and return the merged results in input order. Raises
+            TimeoutError after timeout seconds, e.g. when no worker ever connects
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._all_done():
+                if deadline is not None and time.monotonic() > deadline:
+                    done = len(self._results)
+                    self._close()
+                    raise TimeoutError(f"only {done}/{len(self.shards)} shards done after {timeout}s")
+                self._condition.wait(1)
+        # Give the serving threads a moment to send 'stop' to idle workers
+        time.sleep(0.5)
+        self._close()
+        return [result for shard_id in range(len(self.shards)) for result in self._results[shard_id]]
+
+    def _close(self):
+        listener, self._listener = self._listener, None
+        listener.close()
+
+    def run(self, timeout=None):
+        self.start()
+        return self.wait(timeout)
+
+
+def _shutdown(connection):
+    try:
+        with socket.socket(fileno=os.dup(connection.fileno())) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _make_scorer(mode, model_filename):
+    """Score function on top of the existing feature pipeline and model artifact"""
+    import main as aux_function
+
+    if mode == 'features':
+        return aux_function.get_text_features
+
+    model, feature_names = aux_function.load_model(model_filename)
+
+    def classify(text):
+        prediction, probability, _ = aux_function.classify_text(text, model, feature_names)
+        return {'prediction': prediction, 'probability': float(probability)}
+
+    return classify
+
+
+def run_worker(address, mode='classify', model_filename="ai_detection_model.pkl", score=None, name=None,
+               authkey=None):
+    """Connect to the coordinator and score shards until it says stop"""
+    authkey = authkey or _authkey()
+    if score is None:
+        score = _make_scorer(mode, model_filename)
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+
+    connection = Client(address, authkey=authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    send(('hello', name))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message[0] == 'stop':
+            break
+
+        _, shard_id, texts = message
+        scoring = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(send, scoring), daemon=True)
+        heartbeat.start()
+        try:
+            results = [score(text) for text in texts]
+            send(('result', shard_id, results))
+        except Exception as e:
+            send(('error', shard_id, repr(e)))
+        finally:
+            scoring.set()
+            heartbeat.join()
+    connection.close()
+
+
+def _heartbeat(send, done):
+    while not done.wait(HEARTBEAT_INTERVAL):
+        try:
+            send(('heartbeat',))
+        except OSError:
+            return
+
+
+def run_local(texts, workers=2, shard_size=16, mode='classify', model_filename="ai_detection_model.pkl", score=None,
+              timeout=None):
+    """Coordinator plus worker processes on localhost, for testing the whole system on one machine"""
+    # A fresh secret per run, handed to the workers directly
+    authkey = os.urandom(32)
+    coordinator = Coordinator(texts, shard_size, address=('127.0.0.1', 0), authkey=authkey)
+    address = coordinator.start()
+    processes = [Process(target=run_worker, args=(address, mode, model_filename, score, f"local-{i}", authkey))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        results = coordinator.wait(timeout)
+    except TimeoutError:
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+    return results
+
+
+def read_documents(directories):
+    paths = [os.path.join(directory, filename)
+             for directory in directories
+             for filename in sorted(os.listdir(directory))
+             if os.path.isfile(os.path.join(directory, filename)) and not filename.startswith('.')]
+    texts = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+            texts.append(file.read())
+    return paths, texts
+
+
+def write_results(paths, results, output):
+    with open(output, 'w') as file:
+        for path, result in zip(paths, results):
+            file.write(json.dumps({'document': path, 'result': result}) + '\n')
+    print(f"{len(results)} results written to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded batch scoring across hosts")
+    parser.add_argument("role", choices=["coordinator", "worker", "local"])
+    parser.add_argument("--host", default="127.0.0.1", help="coordinator address (bind address for the coordinator)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--corpus", nargs='*', default=[])
+    parser.add_argument("--output", default="distributed_results.jsonl")
+    parser.add_argument("--shard-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2, help="worker processes for the local role")
+    parser.add_argument("--mode", choices=["classify", "features"], default="classify")
+    parser.add_argument("--model", default="ai_detection_model.pkl")
+    parser.add_argument("--timeout", type=float, help="give up when the corpus isn't scored after this many seconds")
+    args = parser.parse_args()
+
+    if args.role != "local" and not os.getenv(AUTHKEY_ENV):
+        parser.error(f"{AUTHKEY_ENV} must be set to a shared secret for the {args.role} role")
+
+    if args.role == "worker":
+        run_worker((args.host, args.port), args.mode, args.model)
+        return
+
+    paths, texts = read_documents(args.corpus)
+    if args.role == "coordinator":
+        results = Coordinator(texts, args.shard_size, address=(args.host, args.port)).run(args.timeout)
+    else:
+        results = run_local(texts, args.workers, args.shard_size, args.mode, args.model, timeout=args.timeout)
+    write_results(paths, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
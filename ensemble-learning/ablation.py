@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold, cross_val_predict
+
+import main as aux_function
+from cascade import read_labelled
+
+HUMAN = 0
+AI = 1
+
+COPYLEAKS_FEATURE = 'copyleaks'
+FEATURE_CACHE_FILE = "ablation_features.csv"
+
+
+def extract_features_with_cost(filenames, texts, labels, copyleaks_scorer):
+    """
+        Compute every feature column (plus the Copyleaks coverage) for every document, timing
+        each extraction. Returns a frame with one '<feature>' and one '<feature>_seconds' column each
+    """
+    rows = []
+    for filename, text, label in zip(filenames, texts, labels):
+        row = {'filename': filename, 'label': label}
+        extractors = dict(aux_function.FEATURE_FUNCTIONS)
+        extractors[COPYLEAKS_FEATURE] = lambda document: copyleaks_scorer(document, filename)
+        for name, extractor in extractors.items():
+            start = time.perf_counter()
+            row[name] = extractor(text)
+            row[f"{name}_seconds"] = time.perf_counter() - start
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def load_or_extract_features(directories, copyleaks_scorer, cache_file=FEATURE_CACHE_FILE, refresh=False):
+    """Features are cached in cache_file so later ablation runs only retrain models"""
+    if os.path.exists(cache_file) and not refresh:
+        print(f"Using cached features from {cache_file}")
+        return pd.read_csv(cache_file)
+
+    features = extract_features_with_cost(*read_labelled(directories), copyleaks_scorer)
+    features.to_csv(cache_file, index=False)
+    print(f"Features and extraction costs cached to {cache_file}")
+    return features
+
+
+def feature_costs(features, feature_names, copyleaks_seconds=None):
+    """Mean extraction seconds per document of each feature"""
+    costs = {name: features[f"{name}_seconds"].mean() for name in feature_names}
+    if copyleaks_seconds is not None and COPYLEAKS_FEATURE in costs:
+        # Recorded results are looked up locally, so their timing says nothing about the API
+        costs[COPYLEAKS_FEATURE] = copyleaks_seconds
+    return costs
+
+
+def evaluate_subsets(features, feature_names, costs, folds=5):
+    """Cross-validated accuracy/F1 and per-document latency of a model on every non-empty feature subset"""
+    y = features['label'].to_numpy()
+    cv = StratifiedKFold(n_splits=min(folds, np.bincount(y).min()), shuffle=True, random_state=42)
+
+    results = []
+    for size in range(1, len(feature_names) + 1):
+        for subset in itertools.combinations(feature_names, size):
+            y_pred = cross_val_predict(LogisticRegression(max_iter=1000), features[list(subset)], y, cv=cv)
+            results.append({
+                'features': ','.join(subset),
+                'size': size,
+                'accuracy': accuracy_score(y, y_pred),
+                'f1': f1_score(y, y_pred),
+                'seconds_per_document': sum(costs[name] for name in subset),
+            })
+    return pd.DataFrame(results)
+
+
+def pareto_frontier(results, metric='accuracy'):
+    """Subsets that no other subset beats on both metric and latency"""
+    ordered = results.sort_values(['seconds_per_document', metric], ascending=[True, False])
+    frontier = []
+    best = -np.inf
+    for index, row in ordered.iterrows():
+        if row[metric] > best:
+            frontier.append(index)
+            best = row[metric]
+    return results.loc[frontier]
+
+
+def save_subset_model(features, subset, model_filename):
+    """
+        Train on the given feature subset and save it like main.train_and_save_model, so
+        main.classify_text only computes these features at inference
+    """
+    if COPYLEAKS_FEATURE in subset:
+        raise ValueError("Models using the Copyleaks column need ensemble_learning at inference, not main")
+    model = LogisticRegression(max_iter=1000)
+    model.fit(features[subset], features['label'])
+    with open(model_filename, 'wb') as file:
+        pickle.dump((model, subset), file)
+    print(f"\nModel on {subset} saved to {model_filename}")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Feature cost/benefit ablation and accuracy-vs-latency frontier")
+    parser.add_argument("--refresh", action="store_true", help="re-extract features instead of using the cache")
+    parser.add_argument("--no-copyleaks", action="store_true", help="leave the Copyleaks column out")
+    parser.add_argument("--copyleaks-seconds", type=float, default=None,
+                        help="per-document cost to assume for the Copyleaks API (defaults to the measured time)")
+    parser.add_argument("--metric", choices=["accuracy", "f1"], default="accuracy")
+    parser.add_argument("--output", default="ablation_results.csv")
+    parser.add_argument("--save", help="comma separated feature subset to train and save a model for")
+    parser.add_argument("--model-filename", default="ai_detection_model.pkl")
+    args = parser.parse_args()
+
+    import ensemble_learning
+    directories = [("training-ai", AI), ("training-human", HUMAN), ("test-ai", AI), ("test-human", HUMAN)]
+    features = load_or_extract_features(directories, ensemble_learning.get_copyleaks_results, refresh=args.refresh)
+
+    feature_names = list(aux_function.FEATURE_FUNCTIONS)
+    if not args.no_copyleaks:
+        feature_names.append(COPYLEAKS_FEATURE)
+    costs = feature_costs(features, feature_names, args.copyleaks_seconds)
+
+    print("\nMean extraction cost per document:")
+    for name, seconds in sorted(costs.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {name:<20} {seconds * 1000:10.2f} ms")
+
+    results = evaluate_subsets(features, feature_names, costs)
+    frontier = pareto_frontier(results, args.metric)
+    results['pareto'] = results.index.isin(frontier.index)
+    results.sort_values('seconds_per_document').to_csv(args.output, index=False)
+
+    print(f"\nPareto frontier ({args.metric} vs. latency):")
+    print(frontier[['features', 'accuracy', 'f1', 'seconds_per_document']].to_string(index=False))
+    print(f"\nAll {len(results)} subsets written to {args.output}")
+
+    if args.save:
+        save_subset_model(features, args.save.split(','), args.model_filename)
+
+
+if __name__ == "__main__":
+    main()
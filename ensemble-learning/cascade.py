@@ -0,0 +1,207 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from sklearn.ensemble import VotingClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+import main as aux_function
+
+HUMAN = 0
+AI = 1
+
+CHEAP, PERPLEXITY, COPYLEAKS = 0, 1, 2
+STAGE_NAMES = ["cheap features", "+ perplexity", "+ copyleaks"]
+
+
+def _full_features(cheap_features, perplexity):
+    """Insert perplexity into the cheap features so the columns follow main.FEATURE_NAMES"""
+    index = aux_function.FEATURE_NAMES.index('perplexity')
+    return cheap_features[:index] + [perplexity] + cheap_features[index:]
+
+
+class CascadeClassifier:
+    """
+        Three-stage AI-text classifier that only pays for expensive features when needed.
+        Stage 1 uses the cheap lexical features, stage 2 adds GPT-2 perplexity and stage 3
+        adds the Copyleaks AI coverage. A text moves to the next stage only while its AI
+        probability falls inside the uncertainty band (low, high)
+    """
+
+    def __init__(self, copyleaks_scorer, uncertainty_band=(0.2, 0.8)):
+        self.copyleaks_scorer = copyleaks_scorer
+        self.low, self.high = uncertainty_band
+        self.models = [
+            LogisticRegression(max_iter=1000),
+            LogisticRegression(max_iter=1000),
+            VotingClassifier(estimators=[('lr', LogisticRegression(random_state=42, max_iter=1000)),
+                                         ('knn', KNeighborsClassifier()),
+                                         ('tree', DecisionTreeClassifier(random_state=42))], voting='soft'),
+        ]
+        self.stage_counts = [0, 0, 0]
+        self.stage_seconds = [0.0, 0.0, 0.0]
+
+    def stage_features(self, text, filename):
+        """Features of all three stages (every stage needs its own training data)"""
+        cheap_features = aux_function.get_cheap_text_features(text)
+        full_features = _full_features(cheap_features, aux_function.calculate_perplexity(text))
+        return [cheap_features, full_features, full_features + [self.copyleaks_scorer(text, filename)]]
+
+    def fit(self, texts, filenames, labels):
+        stage_x = [[], [], []]
+        for text, filename in zip(texts, filenames):
+            for stage, features in enumerate(self.stage_features(text, filename)):
+                stage_x[stage].append(features)
+        for model, x in zip(self.models, stage_x):
+            model.fit(x, labels)
+        return self
+
+    def is_uncertain(self, probability):
+        return self.low < probability < self.high
+
+    def predict_proba_one(self, text, filename):
+        """Return (AI probability, index of the stage that decided)"""
+        start = time.perf_counter()
+        features = aux_function.get_cheap_text_features(text)
+        probability = self.models[CHEAP].predict_proba([features])[0][1]
+        stage = CHEAP
+
+        if self.is_uncertain(probability):
+            features = _full_features(features, aux_function.calculate_perplexity(text))
+            probability = self.models[PERPLEXITY].predict_proba([features])[0][1]
+            stage = PERPLEXITY
+
+        if self.is_uncertain(probability):
+            features = features + [self.copyleaks_scorer(text, filename)]
+            probability = self.models[COPYLEAKS].predict_proba([features])[0][1]
+            stage = COPYLEAKS
+
+        self.record(stage, time.perf_counter() - start)
+        return probability, stage
+
+    def record(self, stage, seconds):
+        self.stage_counts[stage] += 1
+        self.stage_seconds[stage] += seconds
+
+    def report(self):
+        total = sum(self.stage_counts)
+        print("\n --- Cascade Stages --- ")
+        for stage, name in enumerate(STAGE_NAMES):
+            share = self.stage_counts[stage] / total if total else 0
+            mean_seconds = self.stage_seconds[stage] / self.stage_counts[stage] if self.stage_counts[stage] else 0
+            print(f"{name:<16} decided {self.stage_counts[stage]:>5} ({share:.1%}), mean latency {mean_seconds:.3f}s")
+
+
+def decide(probabilities, low, high):
+    """Stage that decides each document under the band, from the (documents, 3) stage probabilities"""
+    decided = np.full(len(probabilities), COPYLEAKS)
+    for stage in (PERPLEXITY, CHEAP):
+        confident = (probabilities[:, stage] <= low) | (probabilities[:, stage] >= high)
+        decided[confident] = stage
+    return decided
+
+
+def evaluate_tradeoff(cascade, texts, filenames, labels, bands):
+    """
+        Score every stage on every text once (timing each stage's features), then simulate
+        the cascade for each uncertainty band and print accuracy vs. mean latency per document,
+        next to always running the full pipeline. Returns the (documents, 3) probabilities and
+        seconds, so callers derive the cascade's own predictions from this single pass: a second
+        pass would find every Copyleaks result cached and time that stage at about 0
+    """
+    probabilities = np.zeros((len(texts), 3))
+    seconds = np.zeros((len(texts), 3))
+    for i, (text, filename) in enumerate(zip(texts, filenames)):
+        start = time.perf_counter()
+        features = aux_function.get_cheap_text_features(text)
+        seconds[i, CHEAP] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        full_features = _full_features(features, aux_function.calculate_perplexity(text))
+        seconds[i, PERPLEXITY] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        copyleaks_features = full_features + [cascade.copyleaks_scorer(text, filename)]
+        seconds[i, COPYLEAKS] = time.perf_counter() - start
+
+        for stage, stage_features in enumerate([features, full_features, copyleaks_features]):
+            probabilities[i, stage] = cascade.models[stage].predict_proba([stage_features])[0][1]
+
+    labels = np.asarray(labels)
+    full_accuracy = np.mean((probabilities[:, COPYLEAKS] >= 0.5) == labels)
+    full_latency = seconds.sum(axis=1).mean()
+    print("\n --- Cascade Accuracy / Latency --- ")
+    print(f"{'band':<12}{'accuracy':>10}{'latency':>10}{'speedup':>9}  stage share")
+    print(f"{'full':<12}{full_accuracy:>10.2f}{full_latency:>9.3f}s{1:>8.1f}x")
+
+    for low, high in bands:
+        decided = decide(probabilities, low, high)
+        chosen = probabilities[np.arange(len(texts)), decided]
+        # A document pays for every stage up to and including the one that decided it
+        latency = np.mean([seconds[i, :decided[i] + 1].sum() for i in range(len(texts))])
+        accuracy = np.mean((chosen >= 0.5) == labels)
+        shares = " / ".join(f"{np.mean(decided == stage):.0%}" for stage in range(3))
+        print(f"{f'({low}, {high})':<12}{accuracy:>10.2f}{latency:>9.3f}s{full_latency / latency:>8.1f}x  {shares}")
+    return probabilities, seconds
+
+
+def read_directory(dir_name):
+    filenames = []
+    texts = []
+    for filename in sorted(os.listdir(dir_name)):
+        file_path = os.path.join(dir_name, filename)
+        if os.path.isfile(file_path) and not filename.startswith('.'):
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+                texts.append(file.read())
+            filenames.append(filename)
+    return filenames, texts
+
+
+def read_labelled(directories):
+    filenames, texts, labels = [], [], []
+    for dir_name, label in directories:
+        dir_filenames, dir_texts = read_directory(dir_name)
+        filenames += dir_filenames
+        texts += dir_texts
+        labels += [label] * len(dir_texts)
+    return filenames, texts, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and evaluate the cost-aware cascade classifier")
+    parser.add_argument("--low", type=float, default=0.2)
+    parser.add_argument("--high", type=float, default=0.8)
+    parser.add_argument("--use-api", action="store_true",
+                        help="call the Copyleaks API instead of reading the recorded copyleaks_results")
+    args = parser.parse_args()
+
+    import ensemble_learning
+    copyleaks_scorer = ensemble_learning.copyleaks_scan_text_once if args.use_api \
+        else ensemble_learning.get_copyleaks_results
+
+    cascade = CascadeClassifier(copyleaks_scorer, uncertainty_band=(args.low, args.high))
+    train_filenames, train_texts, train_labels = read_labelled([("training-ai", AI), ("training-human", HUMAN)])
+    cascade.fit(train_texts, train_filenames, train_labels)
+
+    test_filenames, test_texts, test_labels = read_labelled([("test-ai", AI), ("test-human", HUMAN)])
+    # One scoring pass for both the band table and the cascade's own predictions, so each
+    # Copyleaks call is made (and timed) once
+    probabilities, seconds = evaluate_tradeoff(cascade, test_texts, test_filenames, test_labels,
+                                               [(0.5, 0.5), (0.3, 0.7), (args.low, args.high), (0.1, 0.9),
+                                                (0.05, 0.95)])
+    predictions = []
+    for i, stage in enumerate(decide(probabilities, cascade.low, cascade.high)):
+        probability = probabilities[i, stage]
+        cascade.record(stage, seconds[i, :stage + 1].sum())
+        predictions.append(1 if probability >= 0.5 else 0)
+        print(f"{test_filenames[i]}\t{probability:.4f}\tstage {stage + 1}")
+
+    ensemble_learning.calc_stats_binary(test_labels, predictions, 0.5)
+    cascade.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import KFold
+
+import main as aux_function
+from cascade import read_directory
+
+RECORDED_RESULTS_FILE = "copyleaks_results.json"
+SURROGATE_FILE = "copyleaks_surrogate.pkl"
+DEFAULT_DIRECTORIES = ["training-ai", "training-human", "test-ai", "test-human"]
+
+# Where the Copyleaks AI-coverage column comes from
+API = 'api'
+SURROGATE = 'surrogate'
+FALLBACK = 'fallback'
+POLICIES = (API, SURROGATE, FALLBACK)
+
+
+def load_recorded_results(path=RECORDED_RESULTS_FILE):
+    """AI coverage (percent) of every recorded scan by lowercase filename; later scans win"""
+    with open(path, 'r') as file:
+        return {record["Name"].lower(): float(record["AI-Coverage"]) for record in json.load(file)}
+
+
+def recorded_training_set(directories=DEFAULT_DIRECTORIES, path=RECORDED_RESULTS_FILE):
+    """(filenames, texts, coverages) of the files in the directories that have a recorded scan"""
+    recorded = load_recorded_results(path)
+    filenames, texts, coverages = [], [], []
+    for dir_name in directories:
+        if not os.path.isdir(dir_name):
+            continue
+        for filename, text in zip(*read_directory(dir_name)):
+            if filename.lower() in recorded:
+                filenames.append(filename)
+                texts.append(text)
+                coverages.append(recorded[filename.lower()])
+    return filenames, texts, coverages
+
+
+class CopyleaksSurrogate:
+    """
+        Predicts Copyleaks AI coverage (percent, like copyleaks_scan_text) from the cheap
+        lexical features with a random forest. The spread of the individual trees' predictions
+        says how sure it is; under the fallback policy spreads above uncertainty_threshold
+        percentage points go to the real API
+    """
+
+    def __init__(self, feature_names=None, n_estimators=100, uncertainty_threshold=15.0):
+        self.feature_names = list(feature_names or aux_function.CHEAP_FEATURE_NAMES)
+        self.uncertainty_threshold = uncertainty_threshold
+        self.model = RandomForestRegressor(n_estimators=n_estimators, min_samples_leaf=2, random_state=42)
+
+    def features(self, text):
+        return aux_function.get_text_features(text, feature_names=self.feature_names)
+
+    def fit_features(self, X, coverages):
+        self.model.fit(np.asarray(X), np.asarray(coverages))
+        return self
+
+    def fit(self, texts, coverages):
+        return self.fit_features([self.features(text) for text in texts], coverages)
+
+    def predict_features(self, X):
+        """Predicted coverages and the standard deviation across trees, both in percentage points"""
+        X = np.asarray(X)
+        per_tree = np.stack([tree.predict(X) for tree in self.model.estimators_])
+        return np.clip(per_tree.mean(axis=0), 0, 100), per_tree.std(axis=0)
+
+    def predict_with_uncertainty(self, text):
+        coverages, spreads = self.predict_features([self.features(text)])
+        return float(coverages[0]), float(spreads[0])
+
+    def __call__(self, text, filename=None):
+        """Same signature as copyleaks_scan_text_once, so it can stand in as a copyleaks_scorer"""
+        return self.predict_with_uncertainty(text)[0]
+
+
+def save_surrogate(surrogate, path=SURROGATE_FILE):
+    with open(path, 'wb') as file:
+        pickle.dump(surrogate, file)
+
+
+def load_surrogate(path=SURROGATE_FILE):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def make_copyleaks_scorer(policy, api_scorer, surrogate=None):
+    """copyleaks_scorer(text, filename) for the policy: the API, the surrogate, or the surrogate with API fallback"""
+    if policy not in POLICIES:
+        raise ValueError(f"unknown Copyleaks policy {policy!r}, expected one of {POLICIES}")
+    if policy == API:
+        return api_scorer
+    if surrogate is None:
+        surrogate = load_surrogate()
+    if policy == SURROGATE:
+        return surrogate
+
+    def surrogate_with_fallback(text, filename):
+        coverage, spread = surrogate.predict_with_uncertainty(text)
+        if spread > surrogate.uncertainty_threshold:
+            return api_scorer(text, filename)
+        return coverage
+
+    return surrogate_with_fallback
+
+
+def evaluate(surrogate, X, coverages, folds=5):
+    """Cross-validated error of the surrogate against the recorded coverages, overall and when confident"""
+    coverages = np.asarray(coverages)
+    predictions = np.zeros(len(coverages))
+    spreads = np.zeros(len(coverages))
+    for train, test in KFold(folds, shuffle=True, random_state=42).split(X):
+        fold = CopyleaksSurrogate(surrogate.feature_names, surrogate.model.n_estimators,
+                                  surrogate.uncertainty_threshold).fit_features(np.asarray(X)[train], coverages[train])
+        predictions[test], spreads[test] = fold.predict_features(np.asarray(X)[test])
+
+    errors = np.abs(predictions - coverages)
+    confident = spreads <= surrogate.uncertainty_threshold
+    report = {
+        'documents': len(coverages),
+        'mae': float(errors.mean()),
+        'rmse': float(np.sqrt(np.mean(errors ** 2))),
+        'within_10_points': float(np.mean(errors <= 10)),
+        'fallback_rate': float(1 - confident.mean()),
+        'confident_mae': float(errors[confident].mean()) if confident.any() else float('nan'),
+    }
+    print(f"{report['documents']} recorded scans, {folds}-fold CV: MAE {report['mae']:.1f} points, "
+          f"RMSE {report['rmse']:.1f}, within 10 points {report['within_10_points']:.0%}")
+    print(f"Spread > {surrogate.uncertainty_threshold:g}: {report['fallback_rate']:.0%} of documents would fall back "
+          f"to the API; MAE on the rest {report['confident_mae']:.1f} points")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local Copyleaks AI-coverage surrogate")
+    parser.add_argument("directories", nargs='*', default=DEFAULT_DIRECTORIES)
+    parser.add_argument("--results", default=RECORDED_RESULTS_FILE)
+    parser.add_argument("--output", default=SURROGATE_FILE)
+    parser.add_argument("--threshold", type=float, default=15.0, help="tree spread (points) that triggers fallback")
+    args = parser.parse_args()
+
+    filenames, texts, coverages = recorded_training_set(args.directories, args.results)
+    if len(texts) < 10:
+        raise SystemExit(f"Only {len(texts)} files with a recorded Copyleaks scan found in {args.directories}")
+
+    surrogate = CopyleaksSurrogate(uncertainty_threshold=args.threshold)
+    X = [surrogate.features(text) for text in texts]
+    evaluate(surrogate, X, coverages)
+
+    surrogate.fit_features(X, coverages)
+    start = time.perf_counter()
+    for text in texts:
+        surrogate(text)
+    print(f"Prediction takes {(time.perf_counter() - start) / len(texts) * 1000:.1f} ms per document")
+    save_surrogate(surrogate, args.output)
+    print(f"Surrogate saved to {args.output}")
+
+
+if __name__ == "__main__":
+    # Run through the imported module, so the pickle refers to copyleaks_surrogate.CopyleaksSurrogate
+    # rather than __main__.CopyleaksSurrogate, which ensemble_learning could not load
+    import copyleaks_surrogate
+
+    copyleaks_surrogate.main()
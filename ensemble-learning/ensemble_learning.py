@@ -3,9 +3,11 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.tree import DecisionTreeClassifier
 from copyleaks_results import copyleaks_results
-from copyleaks_api import copyleaks_scan_text
 
+import argparse
 import os
+import pickle
+import time
 
 import numpy as np
 import sklearn
@@ -14,6 +16,11 @@ from nltk.tokenize import word_tokenize, sent_tokenize
 from nltk.util import ngrams
 
 import main as aux_function
+import copyleaks_surrogate
+import dedup
+import execution
+import manifest
+import pipeline
 
 # nltk.download('punkt')
 # nltk.download('punkt_tab')
@@ -22,37 +29,158 @@ import main as aux_function
 HUMAN = 0
 AI = 1
 
+# Thread limits are applied when main is imported; reuse its layout for the ensemble fit
+execution_config = aux_function.execution_config
 
-def generate_training_xy(dir_name: str, expected_value: int) -> tuple[list[list], list[int]]:
-    """ Generate training x and y values using the files in the given directory"""
-    x_results = []
-    y_results = []
+# Remembers scanned texts so resubmitted essays don't spend another Copyleaks credit
+copyleaks_index = dedup.DedupIndex()
 
-    # Iterate through files in the directory
-    for filename in os.listdir(dir_name):
-        file_path = os.path.join(dir_name, filename)
+ENSEMBLE_MODEL_FILE = "ensemble_model.pkl"
+ENSEMBLE_MANIFEST_FILE = "ensemble_manifest.json"
 
-        # Check if it is a file (and not a directory)
-        if os.path.isfile(file_path) and not filename.startswith('.'):
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                    text = file.read()
+# 'api', 'surrogate' (copyleaks_surrogate.pkl, no credits) or 'fallback' (surrogate, API when it is unsure)
+COPYLEAKS_POLICY = os.getenv("COPYLEAKS_POLICY", copyleaks_surrogate.API)
 
-                # Process the file contents
-                text_feature = aux_function.get_text_features(text)
 
-                # CHANGE copyleaks_scan_text(text, filename) to get_copyleaks_results(text, filename)
-                # to read from copyleaks_results.py file instead of calling the API
-                # or comment this line out if you don't want to use copyleaks results at all
-                text_feature.append(copyleaks_scan_text(text, filename))
+def generate_training_xy(dir_name: str, expected_value: int,
+                         dedup_index: dedup.DedupIndex = None) -> tuple[list[list], list[int]]:
+    """ Generate training x and y values using the files in the given directory.
+        When a dedup_index is given, exact and near copies of files already seen are skipped.
+        File reads, lexical features and GPT-2 scoring run as overlapping pipeline stages
+    """
+    file_paths = [os.path.join(dir_name, filename) for filename in os.listdir(dir_name)
+                  if os.path.isfile(os.path.join(dir_name, filename)) and not filename.startswith('.')]
+    x_results = list(extract_training_features(file_paths, dedup_index).values())
+    return x_results, [expected_value] * len(x_results)
+
+
+def extract_training_features(file_paths: list[str], dedup_index: dedup.DedupIndex = None) -> dict[str, list]:
+    """ Features plus the Copyleaks column of each file, by path, leaving out duplicates and failures """
+
+    def keep(file_path, text):
+        if dedup_index is not None:
+            match = dedup_index.check(file_path, text)
+            if match.kind is not None:
+                print(f"Skipping {file_path}: {match.kind} duplicate of {match.key}")
+                return False
+        return True
+
+    def copyleaks_feature(file_path, text):
+        # CHANGE copyleaks_scorer(text, filename) to get_copyleaks_results(text, filename)
+        # to read from copyleaks_results.py file instead of calling the API or the surrogate
+        # or return [] if you don't want to use copyleaks results at all
+        return [copyleaks_scorer(text, os.path.basename(file_path))]
+
+    if execution_config.workers > 1:
+        results = _parallel_training_features(file_paths, keep, copyleaks_feature)
+    else:
+        feature_pipeline = pipeline.FeaturePipeline(aux_function.get_text_features, aux_function.FEATURE_NAMES,
+                                                    aux_function.gpt2_model, aux_function.gpt2_tokenizer)
+        results = feature_pipeline.run(file_paths, keep, copyleaks_feature)
+        feature_pipeline.report()
+
+    # Failed files are left out, so a manifest refresh retries them next run
+    features = {}
+    for result in results:
+        if result.error is not None:
+            print(f"Error processing file {result.key}: {result.error}")
+            continue
+        features[result.key] = result.features
+    return features
+
+
+def _text_features_or_error(text):
+    """get_text_features in a worker process; an exception is returned so one bad file doesn't stop the map"""
+    try:
+        return aux_function.get_text_features(text), None
+    except Exception as e:
+        return None, e
 
 
-                x_results.append(text_feature)
-                y_results.append(expected_value)
+def _parallel_training_features(file_paths, keep, copyleaks_feature):
+    """
+        Same split as main.process_directory: feature extraction across worker processes, reads and
+        Copyleaks calls in this one. PipelineResults of the kept files, in path order
+    """
+    start = time.perf_counter()
+    read, lexical, copyleaks = pipeline.StageStats('read'), pipeline.StageStats('features'), \
+        pipeline.StageStats('copyleaks')
+    results, texts = {}, {}
+    for file_path in file_paths:
+        stage_start = time.perf_counter()
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+                text = file.read()
+            if keep(file_path, text):
+                texts[file_path] = text
+        except Exception as e:
+            results[file_path] = pipeline.PipelineResult(file_path, None, e)
+        read.items += 1
+        read.busy += time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    rows = execution.parallel_map(_text_features_or_error, list(texts.values()), execution_config)
+    lexical.items += len(rows)
+    lexical.busy += time.perf_counter() - stage_start
+
+    for (file_path, text), (row, error) in zip(texts.items(), rows):
+        if error is None:
+            stage_start = time.perf_counter()
+            try:
+                row = row + copyleaks_feature(file_path, text)
             except Exception as e:
-                print(f"Error processing file {file_path}: {e}")
+                error = e
+            copyleaks.items += 1
+            copyleaks.busy += time.perf_counter() - stage_start
+        results[file_path] = pipeline.PipelineResult(file_path, None if error else row, error)
+
+    pipeline.print_stage_report([read, lexical, copyleaks], time.perf_counter() - start)
+    return [results[file_path] for file_path in file_paths if file_path in results]
 
-    return x_results, y_results
+
+def fit_from_manifest(ensemble_model: VotingClassifier, manifest_path: str = ENSEMBLE_MANIFEST_FILE,
+                      model_filename: str = ENSEMBLE_MODEL_FILE) -> VotingClassifier:
+    """ Fit on the training folders through a dataset manifest: only added or modified files are
+        scanned (features and Copyleaks credits), and an unchanged dataset reuses the saved model
+    """
+    # The policy is part of the column name, so switching it re-extracts instead of mixing API and surrogate values
+    dataset = manifest.DatasetManifest(manifest_path, aux_function.FEATURE_NAMES + [f'copyleaks:{COPYLEAKS_POLICY}'])
+    dataset.refresh([("training-ai", AI), ("training-human", HUMAN)], extract_training_features)
+
+    # n_jobs only changes how the fit is run, not its result
+    hyperparameters = {'estimators': [(name, repr(estimator)) for name, estimator in ensemble_model.estimators],
+                       'voting': ensemble_model.voting, 'copyleaks_policy': COPYLEAKS_POLICY}
+    if dataset.is_fit_current(hyperparameters, model_filename):
+        dataset.save()
+        print(f"Training data unchanged, reusing {model_filename}")
+        with open(model_filename, 'rb') as file:
+            return pickle.load(file)
+
+    X_train, Y_train, _ = dataset.training_set()
+    ensemble_model.fit(X_train, Y_train)
+    with open(model_filename + '.tmp', 'wb') as file:
+        pickle.dump(ensemble_model, file)
+    os.replace(model_filename + '.tmp', model_filename)
+    dataset.mark_fitted(hyperparameters)
+    dataset.save()
+    return ensemble_model
+
+
+def copyleaks_scan_text_once(text, filename: str):
+    """Call the Copyleaks API, reusing the result of an exact duplicate that was already scanned"""
+    match = copyleaks_index.check(filename, text)
+    if match.kind == dedup.EXACT and copyleaks_index.get_result(match.key) is not None:
+        return copyleaks_index.get_result(match.key)
+    if match.kind == dedup.NEAR:
+        print(f"{filename} is a near duplicate of {match.key} (similarity {match.similarity:.2f})")
+
+    # Logs in to Copyleaks on first use, so the surrogate policy runs without credentials
+    from copyleaks_api import copyleaks_scan_text
+
+    ai_coverage = copyleaks_scan_text(text, filename)
+    # An exact copy without a result (e.g. indexed by another file) keeps the text under its own key
+    copyleaks_index.set_result(match.key if match.kind == dedup.EXACT else filename, ai_coverage)
+    return ai_coverage
 
 
 def get_copyleaks_results(text, filename: str):
@@ -65,6 +193,17 @@ def get_copyleaks_results(text, filename: str):
     print("cant find copyleaks for file " + filename)
 
 
+_copyleaks_scorer = None
+
+
+def copyleaks_scorer(text, filename: str):
+    """Copyleaks AI coverage of the text under COPYLEAKS_POLICY"""
+    global _copyleaks_scorer
+    if _copyleaks_scorer is None:
+        _copyleaks_scorer = copyleaks_surrogate.make_copyleaks_scorer(COPYLEAKS_POLICY, copyleaks_scan_text_once)
+    return _copyleaks_scorer(text, filename)
+
+
 def perform_testing(dir_name: str, model: VotingClassifier) -> list[int]:
     """ Performs testing on the files in the given directory"""
     X_test = []
@@ -79,10 +218,10 @@ def perform_testing(dir_name: str, model: VotingClassifier) -> list[int]:
                 text = file.read()
                 text_feature = aux_function.get_text_features(text)
 
-                # CHANGE copyleaks_scan_text(text, filename) to get_copyleaks_results(text, filename)
-                # to read from copyleaks_results.py file instead of calling the API
+                # CHANGE copyleaks_scorer(text, filename) to get_copyleaks_results(text, filename)
+                # to read from copyleaks_results.py file instead of calling the API or the surrogate
                 # or comment this line out if you don't want to use copyleaks results at all
-                text_feature.append(copyleaks_scan_text(text, filename))
+                text_feature.append(copyleaks_scorer(text, filename))
 
                 X_test.append(text_feature)
                 filenames.append(filename)
@@ -92,9 +231,10 @@ def perform_testing(dir_name: str, model: VotingClassifier) -> list[int]:
     return results, filenames
 
 
-def ensemble():
+def ensemble(incremental: bool = False):
     """
-        The main ensemble function
+        The main ensemble function. With incremental, training goes through the dataset
+        manifest (see fit_from_manifest) instead of rescanning every training file
     """
     # Create the individual classifiers
     lr = LogisticRegression(random_state=42, max_iter=1000)
@@ -102,19 +242,25 @@ def ensemble():
     tree = DecisionTreeClassifier(random_state=42)
 
     # Create the ensemble classifier
-    ensemble_model = VotingClassifier(estimators=[('lr', lr), ('knn', knn), ('tree', tree)], voting='soft')
-
-    X_train = []
-    Y_train = []
-
-    # generate training data
-    for dir_name, label in [("training-ai", AI), ("training-human", HUMAN)]:
-        train_x, train_y = generate_training_xy(dir_name, label)
-        X_train += train_x
-        Y_train += train_y
-
-    # perform training
-    ensemble_model.fit(X_train, Y_train)
+    ensemble_model = VotingClassifier(estimators=[('lr', lr), ('knn', knn), ('tree', tree)], voting='soft',
+                                      n_jobs=execution_config.fit_jobs)
+
+    if incremental:
+        ensemble_model = fit_from_manifest(ensemble_model)
+    else:
+        X_train = []
+        Y_train = []
+
+        # generate training data, skipping copies across both folders
+        training_index = dedup.DedupIndex()
+        for dir_name, label in [("training-ai", AI), ("training-human", HUMAN)]:
+            train_x, train_y = generate_training_xy(dir_name, label, training_index)
+            X_train += train_x
+            Y_train += train_y
+        training_index.report()
+
+        # perform training
+        ensemble_model.fit(X_train, Y_train)
 
     # perform testing
     ai_test_results, ai_filenames = perform_testing("test-ai", ensemble_model)
@@ -134,6 +280,7 @@ def ensemble():
     calculate_overall_stats(ai_test_results.tolist(), human_test_results.tolist())
     calculate_human_only_stats(human_test_results.tolist())
     calculate_ai_only_stats(ai_test_results.tolist())
+    copyleaks_index.report()
 
     return
 
@@ -226,7 +373,11 @@ def calc_stats_binary(y_true, y_pred_prob, threshold):
 
 
 def main():
-    ensemble()
+    parser = argparse.ArgumentParser(description="Train and evaluate the ensemble classifier")
+    parser.add_argument("--incremental", action="store_true",
+                        help="extract features only for changed training files and skip an unchanged fit")
+    args = parser.parse_args()
+    ensemble(args.incremental)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from threadpoolctl import threadpool_limits
+
+EXECUTION_CONFIG_FILE = "execution_config.json"
+
+# Read by OpenMP/BLAS runtimes that initialize after we run, and inherited by worker processes
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+@dataclass
+class ExecutionConfig:
+    """How the host's cores are split: worker processes x threads inside each worker"""
+    workers: int = 1
+    threads_per_worker: int = 1
+    # n_jobs for VotingClassifier.fit
+    fit_jobs: int = 1
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_config():
+    return ExecutionConfig(workers=1, threads_per_worker=available_cores(), fit_jobs=1)
+
+
+def load_execution_config(path=EXECUTION_CONFIG_FILE):
+    """
+        Load the config written by `autotune`, falling back to one worker using every core.
+        AI_DETECTION_WORKERS / AI_DETECTION_THREADS / AI_DETECTION_FIT_JOBS override it
+    """
+    config = default_config()
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            config = ExecutionConfig(**json.load(file))
+
+    config.workers = int(os.getenv("AI_DETECTION_WORKERS", config.workers))
+    config.threads_per_worker = int(os.getenv("AI_DETECTION_THREADS", config.threads_per_worker))
+    config.fit_jobs = int(os.getenv("AI_DETECTION_FIT_JOBS", config.fit_jobs))
+
+    # Never hand out more threads than the host has cores
+    cores = available_cores()
+    config.workers = max(1, min(config.workers, cores))
+    config.threads_per_worker = max(1, min(config.threads_per_worker, cores // config.workers))
+    config.fit_jobs = max(1, min(config.fit_jobs, cores))
+    return config
+
+
+def save_execution_config(config, path=EXECUTION_CONFIG_FILE):
+    with open(path, 'w') as file:
+        json.dump(asdict(config), file, indent=4)
+
+
+def apply_thread_limits(threads):
+    """Cap torch intra-op threads and every BLAS/OpenMP pool in this process"""
+    for variable in THREAD_ENV_VARS:
+        os.environ[variable] = str(threads)
+    torch.set_num_threads(threads)
+    threadpool_limits(limits=threads)
+
+
+def configure(config=None):
+    """Apply the execution config to the current process and return it"""
+    if config is None:
+        config = load_execution_config()
+    apply_thread_limits(config.threads_per_worker)
+    return config
+
+
+def parallel_map(function, items, config):
+    """
+        Map function over items with config.workers processes, each limited to
+        config.threads_per_worker threads. Runs inline when there is a single worker
+    """
+    items = list(items)
+    if config.workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    chunksize = max(1, len(items) // (config.workers * 4))
+    with Pool(config.workers, initializer=apply_thread_limits, initargs=(config.threads_per_worker,)) as pool:
+        return pool.map(function, items, chunksize=chunksize)
+
+
+def candidate_layouts(cores):
+    """workers x threads combinations that use between half and all of the cores"""
+    sizes = sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+    return [(workers, threads) for workers in sizes for threads in sizes
+            if cores // 2 < workers * threads <= cores]
+
+
+def _benchmark_perplexity(texts, layouts):
+    import main as aux_function
+
+    results = {}
+    for workers, threads in layouts:
+        config = ExecutionConfig(workers=workers, threads_per_worker=threads)
+        apply_thread_limits(threads)
+        start = time.perf_counter()
+        parallel_map(aux_function.calculate_perplexity, texts, config)
+        elapsed = time.perf_counter() - start
+        results[(workers, threads)] = len(texts) / elapsed
+        print(f"calculate_perplexity  workers={workers:<3} threads={threads:<3} "
+              f"{results[(workers, threads)]:.2f} docs/s")
+    return results
+
+
+def _benchmark_fit(layouts, n_samples=5000, n_features=7):
+    from sklearn.ensemble import VotingClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.tree import DecisionTreeClassifier
+
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(n_samples, n_features))
+    y = (X[:, 0] + rng.normal(scale=0.5, size=n_samples) > 0).astype(int)
+
+    results = {}
+    for jobs, threads in layouts:
+        model = VotingClassifier(estimators=[('lr', LogisticRegression(random_state=42, max_iter=1000)),
+                                             ('knn', KNeighborsClassifier()),
+                                             ('tree', DecisionTreeClassifier(random_state=42))],
+                                 voting='soft', n_jobs=jobs)
+        apply_thread_limits(threads)
+        start = time.perf_counter()
+        model.fit(X, y)
+        results[(jobs, threads)] = time.perf_counter() - start
+        print(f"VotingClassifier.fit  jobs={jobs:<3} threads={threads:<3} {results[(jobs, threads)]:.3f} s")
+    return results
+
+
+def autotune(texts, path=EXECUTION_CONFIG_FILE):
+    """
+        Benchmark calculate_perplexity and VotingClassifier.fit for every workers x threads
+        layout on this host, then save and return the fastest one
+    """
+    layouts = candidate_layouts(available_cores())
+    perplexity_throughput = _benchmark_perplexity(texts, layouts)
+    fit_seconds = _benchmark_fit(layouts)
+
+    workers, threads = max(perplexity_throughput, key=perplexity_throughput.get)
+    fit_jobs, _ = min(fit_seconds, key=fit_seconds.get)
+    config = ExecutionConfig(workers=workers, threads_per_worker=threads, fit_jobs=fit_jobs)
+    save_execution_config(config, path)
+
+    print(f"\nRecommended layout for {available_cores()} cores: {config}")
+    print(f"Saved to {path}")
+    return config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the best workers x threads layout for this host")
+    parser.add_argument("command", choices=["autotune", "show"])
+    parser.add_argument("--corpus", help="directory of .txt files to benchmark perplexity on")
+    parser.add_argument("--documents", type=int, default=32)
+    parser.add_argument("--output", default=EXECUTION_CONFIG_FILE)
+    args = parser.parse_args()
+
+    if args.command == "show":
+        print(load_execution_config(args.output))
+    else:
+        if args.corpus:
+            from token_cache import read_corpus
+            corpus = read_corpus([args.corpus])[:args.documents]
+        else:
+            corpus = ["The quick brown fox jumps over the lazy dog. " * 40] * args.documents
+        autotune(corpus, args.output)
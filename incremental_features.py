@@ -0,0 +1,204 @@
+import argparse
+import heapq
+import sys
+
+import nltk
+from nltk.tokenize import word_tokenize, sent_tokenize
+
+import readability
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+# Characters kept for perplexity; calculate_perplexity only scores the first 1024 GPT-2 tokens anyway
+PERPLEXITY_PREFIX_CHARS = 16 * 1024
+_HASH_MASK = (1 << 64) - 1
+
+
+def iter_chunks(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _SentenceStream:
+    """
+        Turns chunks into complete sentences. The last sentence of the buffer is held back until
+        more text arrives, since the next chunk may continue it or change where punkt splits it;
+        a buffer over max_carry characters with no boundary is cut at its last whitespace
+    """
+
+    def __init__(self, max_carry):
+        self.max_carry = max_carry
+        self.carry = ''
+
+    def feed(self, chunk):
+        buffer = self.carry + chunk
+        sentences = sent_tokenize(buffer)
+        if len(sentences) < 2:
+            if len(buffer) <= self.max_carry:
+                self.carry = buffer
+                return []
+            cut = buffer.rfind(' ', 0, len(buffer) - 1) + 1 or len(buffer)
+            self.carry = buffer[cut:]
+            return [buffer[:cut]]
+        self.carry = buffer[buffer.rindex(sentences[-1]):]
+        return sentences[:-1]
+
+    def close(self):
+        sentences = sent_tokenize(self.carry) if self.carry.strip() else []
+        self.carry = ''
+        return sentences
+
+
+class DistinctCounter:
+    """
+        Number of distinct 64-bit hashes. Exact with max_hashes=None; otherwise a k-minimum-values
+        sketch that keeps only the max_hashes smallest hashes and estimates the rest
+    """
+
+    def __init__(self, max_hashes=None):
+        self.max_hashes = max_hashes
+        self.hashes = set()
+        self._heap = []
+        self.truncated = False
+
+    def add(self, value):
+        if value in self.hashes:
+            return
+        if self.max_hashes is None or len(self.hashes) < self.max_hashes:
+            self.hashes.add(value)
+            heapq.heappush(self._heap, -value)
+        elif value < -self._heap[0]:
+            # Replace the largest kept hash
+            self.hashes.discard(-heapq.heappushpop(self._heap, -value))
+            self.hashes.add(value)
+            self.truncated = True
+        else:
+            self.truncated = True
+
+    def count(self):
+        if not self.truncated:
+            return len(self.hashes)
+        return (self.max_hashes - 1) * (1 << 64) / (-self._heap[0] + 1)
+
+
+class FeatureAccumulator:
+    """
+        get_text_features for a document fed in chunks, keeping running counters instead of the
+        text: word, stopword and character totals, sentence counts, readability syllable counts
+        and a set of trigram hashes (bounded with max_ngram_hashes). Memory is O(chunk size) plus
+        the trigram set. Sentences are split as the batch functions split the whole text, so the
+        features match them except where punkt would split differently given the entire document
+    """
+
+    def __init__(self, feature_names=None, max_ngram_hashes=None, chunk_size=DEFAULT_CHUNK_SIZE, perplexity=None):
+        import main as aux_function
+
+        self.feature_names = list(feature_names or aux_function.FEATURE_NAMES)
+        unsupported = [name for name in self.feature_names if name not in aux_function.FEATURE_FUNCTIONS]
+        if unsupported:
+            raise ValueError(f"no incremental version of {unsupported}")
+        self.perplexity = perplexity or aux_function.calculate_perplexity
+        self.stopwords = set(nltk.corpus.stopwords.words('english'))
+
+        # Lexical density, word length and n-grams tokenize the lowercased text, sentence length the original
+        self.lower_sentences = _SentenceStream(4 * chunk_size)
+        self.sentences = _SentenceStream(4 * chunk_size)
+        self.lower_words = 0
+        self.content_words = 0
+        self.characters = 0
+        self.trigrams = DistinctCounter(max_ngram_hashes)
+        self.trigram_total = 0
+        self.previous_tokens = ()
+        self.words = 0
+        self.sentence_total = 0
+        self.readability_words = 0
+        self.syllables = 0
+        self.complex_words = 0
+        self.regex_sentences = 0
+        self.fragments = 0
+        self.prefix = ''
+
+    def update(self, chunk):
+        if len(self.prefix) < PERPLEXITY_PREFIX_CHARS:
+            self.prefix += chunk[:PERPLEXITY_PREFIX_CHARS - len(self.prefix)]
+        self._add_lower(self.lower_sentences.feed(chunk.lower()))
+        self._add_original(self.sentences.feed(chunk))
+
+    def _add_lower(self, sentences):
+        for sentence in sentences:
+            tokens = word_tokenize(sentence, preserve_line=True)
+            self.lower_words += len(tokens)
+            self.content_words += sum(1 for token in tokens if token not in self.stopwords)
+            self.characters += sum(len(token) for token in tokens)
+
+            # Trigrams run across sentence boundaries, as over the document's whole token list
+            window = self.previous_tokens + tuple(tokens)
+            for i in range(len(window) - 2):
+                self.trigrams.add(hash(window[i:i + 3]) & _HASH_MASK)
+            self.trigram_total += max(0, len(window) - 2)
+            self.previous_tokens = window[-2:]
+
+    def _add_original(self, sentences):
+        for sentence in sentences:
+            self.words += len(word_tokenize(sentence, preserve_line=True))
+            self.sentence_total += 1
+
+            words = readability.lexicon(sentence)
+            syllables, complex_words = readability.syllable_counts(words)
+            self.readability_words += len(words)
+            self.syllables += syllables
+            self.complex_words += complex_words
+            regex_sentences, fragments = readability.sentence_counts(sentence)
+            self.regex_sentences += regex_sentences
+            self.fragments += fragments
+
+    def features(self):
+        """Close the document and return its features in feature_names order"""
+        self._add_lower(self.lower_sentences.close())
+        self._add_original(self.sentences.close())
+        values = {
+            'readability': readability.scores_from_counts(self.readability_words, self.syllables, self.complex_words,
+                                                          max(1, self.regex_sentences - self.fragments))[
+                'flesch_reading_ease'],
+            'lexical_density': self.content_words / self.lower_words if self.lower_words else 0,
+            'avg_word_length': self.characters / self.lower_words if self.lower_words else 0,
+            'ngram_diversity': self.trigrams.count() / self.trigram_total if self.trigram_total else 0.0,
+            'avg_sentence_length': self.words / self.sentence_total if self.sentence_total else 0,
+        }
+        if 'perplexity' in self.feature_names:
+            values['perplexity'] = self.perplexity(self.prefix)
+        return [values[name] for name in self.feature_names]
+
+
+def features_from_chunks(chunks, feature_names=None, max_ngram_hashes=None):
+    accumulator = FeatureAccumulator(feature_names, max_ngram_hashes)
+    for chunk in chunks:
+        accumulator.update(chunk)
+    return accumulator.features()
+
+
+def features_from_file(path, feature_names=None, max_ngram_hashes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """get_text_features of a file of any size, read chunk_size characters at a time"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+        accumulator = FeatureAccumulator(feature_names, max_ngram_hashes, chunk_size)
+        for chunk in iter_chunks(file, chunk_size):
+            accumulator.update(chunk)
+    return accumulator.features()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Features of very large documents, computed chunk by chunk")
+    parser.add_argument("paths", nargs='+', help="files, or - for stdin")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--max-ngram-hashes", type=int, help="bound the trigram set (approximate diversity)")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if path == '-':
+            features = features_from_chunks(iter_chunks(sys.stdin, args.chunk_size),
+                                            max_ngram_hashes=args.max_ngram_hashes)
+        else:
+            features = features_from_file(path, max_ngram_hashes=args.max_ngram_hashes, chunk_size=args.chunk_size)
+        print(path, features)
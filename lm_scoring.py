@@ -0,0 +1,443 @@
+import argparse
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import stats
+
+# Sequence positions pushed through the LM head at once; peak memory is chunk_size x vocabulary per row
+LM_HEAD_CHUNK_SIZE = 128
+
+PerplexityEstimate = namedtuple('PerplexityEstimate', ['perplexity', 'low', 'high', 'windows_scored', 'windows_total'])
+
+
+def token_losses(model, input_ids, attention_mask=None, chunk_size=LM_HEAD_CHUNK_SIZE):
+    """
+        Next-token negative log-likelihood of every position, shape (batch, length - 1), with 0 where
+        the target is padding. The final hidden states are computed once and pushed through the
+        LM head chunk_size positions at a time, so the full length x vocabulary logits never exist
+    """
+    with torch.no_grad():
+        hidden_states = model.transformer(input_ids, attention_mask=attention_mask).last_hidden_state[:, :-1]
+        targets = input_ids[:, 1:]
+        if attention_mask is not None:
+            targets = targets.masked_fill(attention_mask[:, 1:] == 0, -100)
+        return _chunked_losses(model, hidden_states, targets, chunk_size)
+
+
+def _chunked_losses(model, hidden_states, targets, chunk_size):
+    """Cross-entropy of the LM head on hidden_states against targets (-100 is ignored), chunk by chunk"""
+    losses = torch.zeros(targets.shape, dtype=torch.float32)
+    for start in range(0, targets.shape[1], chunk_size):
+        logits = model.lm_head(hidden_states[:, start:start + chunk_size]).float()
+        losses[:, start:start + chunk_size] = F.cross_entropy(logits.transpose(1, 2),
+                                                              targets[:, start:start + chunk_size],
+                                                              ignore_index=-100, reduction='none')
+    return losses
+
+
+def mean_token_loss(model, input_ids, chunk_size=LM_HEAD_CHUNK_SIZE):
+    """Same value as model(input_ids, labels=input_ids).loss for a single sequence"""
+    return token_losses(model, input_ids, chunk_size=chunk_size).mean().item()
+
+
+def perplexities_from_ids(encodings, model, pad_token_id, chunk_size=LM_HEAD_CHUNK_SIZE):
+    """Perplexity of each token id sequence, scored together as one right-padded batch"""
+    width = max(len(ids) for ids in encodings)
+    input_ids = torch.full((len(encodings), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(encodings), width), dtype=torch.long)
+    for row, ids in enumerate(encodings):
+        input_ids[row, :len(ids)] = torch.as_tensor(np.asarray(ids, dtype=np.int64))
+        attention_mask[row, :len(ids)] = 1
+
+    losses = token_losses(model, input_ids, attention_mask, chunk_size)
+    counts = attention_mask[:, 1:].sum(dim=1)
+    return torch.exp(losses.sum(dim=1) / counts).tolist()
+
+
+def batch_perplexities(texts, model, tokenizer, max_length=1024, batch_size=8, chunk_size=LM_HEAD_CHUNK_SIZE,
+                       min_shared_prefix=None, packed=False):
+    """
+        Perplexity of each text (truncated to max_length tokens), scoring right-padded batches.
+        With min_shared_prefix, texts sharing at least that many leading tokens reuse one pass over the prefix;
+        packed puts many short texts into each max_length row instead of padding
+    """
+    perplexities = []
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    if packed:
+        encodings = [tokenizer(text, truncation=True, max_length=max_length).input_ids for text in texts]
+        return packed_perplexities(encodings, model, pad_token_id, max_length, chunk_size=chunk_size)
+    for start in range(0, len(texts), batch_size):
+        encodings = [tokenizer(text, truncation=True, max_length=max_length).input_ids
+                     for text in texts[start:start + batch_size]]
+        if min_shared_prefix:
+            perplexities += shared_prefix_perplexities(encodings, model, pad_token_id, min_shared_prefix,
+                                                       batch_size, chunk_size)
+        else:
+            perplexities += perplexities_from_ids(encodings, model, pad_token_id, chunk_size)
+    return perplexities
+
+
+def pack_sequences(lengths, row_length):
+    """
+        First-fit-decreasing assignment of sequences to rows of row_length tokens: a list of rows,
+        each a list of (sequence index, offset in the row)
+    """
+    rows, free = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row, space in enumerate(free):
+            if lengths[index] <= space:
+                break
+        else:
+            rows.append([])
+            free.append(row_length)
+            row = len(rows) - 1
+        rows[row].append((index, row_length - free[row]))
+        free[row] -= lengths[index]
+    return rows
+
+
+def _packed_hidden_states(model, input_ids, position_ids, segment_ids):
+    """
+        Final hidden states of rows holding several documents. GPT2Model only takes a 2D padding
+        mask, so the blocks are run directly with a block-diagonal causal mask: a token attends to
+        earlier tokens of its own document only. Padding (segment -1) attends to itself
+    """
+    transformer = model.transformer
+    length = input_ids.shape[1]
+    causal = torch.tril(torch.ones((length, length), dtype=torch.bool))
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+    allowed |= torch.eye(length, dtype=torch.bool)
+    dtype = transformer.wte.weight.dtype
+    attention_mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+    hidden_states = transformer.drop(transformer.wte(input_ids) + transformer.wpe(position_ids))
+    for block in transformer.h:
+        hidden_states = block(hidden_states, attention_mask=attention_mask)[0]
+    return transformer.ln_f(hidden_states)
+
+
+def packed_perplexities(encodings, model, pad_token_id, row_length=1024, batch_size=4,
+                        chunk_size=LM_HEAD_CHUNK_SIZE):
+    """
+        Perplexity of each token id sequence, with many short sequences packed into each row of
+        row_length tokens. Position ids restart at 0 for every sequence and attention never crosses
+        sequences, so each perplexity matches scoring the sequence on its own
+    """
+    encodings = [np.asarray(ids[:row_length], dtype=np.int64) for ids in encodings]
+    perplexities = [math.nan] * len(encodings)
+    scored = [i for i, ids in enumerate(encodings) if len(ids) >= 2]
+    rows = [[(scored[i], offset) for i, offset in row]
+            for row in pack_sequences([len(encodings[i]) for i in scored], row_length)]
+
+    with torch.no_grad():
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            width = max(offset + len(encodings[index]) for row in batch for index, offset in row)
+            input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+            position_ids = torch.zeros((len(batch), width), dtype=torch.long)
+            segment_ids = torch.full((len(batch), width), -1, dtype=torch.long)
+            for r, row in enumerate(batch):
+                for index, offset in row:
+                    end = offset + len(encodings[index])
+                    input_ids[r, offset:end] = torch.from_numpy(encodings[index])
+                    position_ids[r, offset:end] = torch.arange(end - offset)
+                    segment_ids[r, offset:end] = index
+
+            hidden_states = _packed_hidden_states(model, input_ids, position_ids, segment_ids)
+            # A position predicts the next token only within the same document
+            targets = input_ids[:, 1:].masked_fill((segment_ids[:, 1:] != segment_ids[:, :-1]) |
+                                                   (segment_ids[:, 1:] < 0), -100)
+            losses = _chunked_losses(model, hidden_states[:, :-1], targets, chunk_size)
+            for r, row in enumerate(batch):
+                for index, offset in row:
+                    end = offset + len(encodings[index])
+                    perplexities[index] = math.exp(losses[r, offset:end - 1].mean().item())
+    return perplexities
+
+
+def bench_packing(texts, model, tokenizer, max_length=1024, batch_size=8):
+    """Throughput of packed scoring against padded batches and one document at a time"""
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    encodings = [tokenizer(text, truncation=True, max_length=max_length).input_ids for text in texts]
+    encodings = [ids for ids in encodings if len(ids) >= 2]
+
+    start = time.perf_counter()
+    single = [perplexities_from_ids([ids], model, pad_token_id)[0] for ids in encodings]
+    single_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    padded = [perplexity for i in range(0, len(encodings), batch_size)
+              for perplexity in perplexities_from_ids(encodings[i:i + batch_size], model, pad_token_id)]
+    padded_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    packed = packed_perplexities(encodings, model, pad_token_id, max_length)
+    packed_seconds = time.perf_counter() - start
+
+    difference = max(abs(a - b) / a for a, b in zip(single, packed))
+    print(f"{len(encodings)} documents, mean {np.mean([len(ids) for ids in encodings]):.0f} tokens: "
+          f"{len(encodings) / single_seconds:.1f} docs/s one at a time, {len(encodings) / padded_seconds:.1f} padded, "
+          f"{len(encodings) / packed_seconds:.1f} packed; max relative difference {difference:.2e} "
+          f"(padded {max(abs(a - b) / a for a, b in zip(single, padded)):.2e})")
+
+
+def _common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    different = np.flatnonzero(np.asarray(a[:length]) != np.asarray(b[:length]))
+    return int(different[0]) if len(different) else length
+
+
+def group_shared_prefixes(encodings, min_prefix):
+    """
+        (indices, prefix_length) groups of sequences whose first prefix_length tokens are identical,
+        from adjacent sequences in sorted order. The prefix always leaves every member at least one
+        token of its own; sequences sharing fewer than min_prefix tokens with a neighbour stand alone
+    """
+    order = sorted(range(len(encodings)), key=lambda i: list(encodings[i]))
+    groups = []
+    indices, prefix_length = [order[0]], len(encodings[order[0]]) - 1
+    for previous, current in zip(order, order[1:]):
+        shared = min(prefix_length, _common_prefix_length(encodings[previous], encodings[current]),
+                     len(encodings[current]) - 1)
+        if shared >= min_prefix:
+            indices.append(current)
+            prefix_length = shared
+        else:
+            groups.append((indices, prefix_length))
+            indices, prefix_length = [current], len(encodings[current]) - 1
+    groups.append((indices, prefix_length))
+    return groups
+
+
+def _legacy_cache(past_key_values):
+    return past_key_values.to_legacy_cache() if hasattr(past_key_values, 'to_legacy_cache') else past_key_values
+
+
+def _score_on_prefix(model, prefix, continuations, pad_token_id, batch_size, chunk_size):
+    """
+        Summed NLL and predicted-token count of prefix + continuation for each continuation. The
+        prefix goes through the transformer once; continuations are scored in right-padded batches
+        on top of its key/value cache
+    """
+    with torch.no_grad():
+        prefix_ids = torch.as_tensor(np.asarray(prefix, dtype=np.int64)).unsqueeze(0)
+        output = model.transformer(prefix_ids, use_cache=True)
+        prefix_loss = _chunked_losses(model, output.last_hidden_state[:, :-1], prefix_ids[:, 1:], chunk_size).sum()
+        # The last prefix position predicts each continuation's first token
+        last_hidden = output.last_hidden_state[:, -1:]
+        past_key_values = _legacy_cache(output.past_key_values)
+
+        totals = []
+        for start in range(0, len(continuations), batch_size):
+            batch = continuations[start:start + batch_size]
+            width = max(len(ids) for ids in batch)
+            input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+            mask = torch.zeros((len(batch), width), dtype=torch.long)
+            for row, ids in enumerate(batch):
+                input_ids[row, :len(ids)] = torch.as_tensor(np.asarray(ids, dtype=np.int64))
+                mask[row, :len(ids)] = 1
+
+            past = tuple((key.expand(len(batch), -1, -1, -1), value.expand(len(batch), -1, -1, -1))
+                         for key, value in past_key_values)
+            attention_mask = torch.cat([torch.ones((len(batch), len(prefix)), dtype=torch.long), mask], dim=1)
+            position_ids = torch.arange(len(prefix), len(prefix) + width).unsqueeze(0).expand(len(batch), -1)
+            hidden_states = model.transformer(input_ids, past_key_values=past, attention_mask=attention_mask,
+                                              position_ids=position_ids).last_hidden_state
+
+            hidden_states = torch.cat([last_hidden.expand(len(batch), -1, -1), hidden_states[:, :-1]], dim=1)
+            targets = input_ids.masked_fill(mask == 0, -100)
+            losses = _chunked_losses(model, hidden_states, targets, chunk_size).sum(dim=1)
+            totals += [(prefix_loss.item() + loss, len(prefix) - 1 + len(ids))
+                       for loss, ids in zip(losses.tolist(), batch)]
+    return totals
+
+
+def shared_prefix_perplexities(encodings, model, pad_token_id, min_prefix=32, batch_size=8,
+                               chunk_size=LM_HEAD_CHUNK_SIZE):
+    """
+        Same perplexities as perplexities_from_ids, but sequences sharing a prefix of at least
+        min_prefix tokens (a prompt or template header) compute the prefix's key/values once
+    """
+    perplexities = [None] * len(encodings)
+    for indices, prefix_length in group_shared_prefixes(encodings, min_prefix):
+        if len(indices) == 1:
+            perplexities[indices[0]] = perplexities_from_ids([encodings[indices[0]]], model, pad_token_id,
+                                                             chunk_size)[0]
+            continue
+        totals = _score_on_prefix(model, encodings[indices[0]][:prefix_length],
+                                  [encodings[i][prefix_length:] for i in indices], pad_token_id, batch_size, chunk_size)
+        for i, (total, count) in zip(indices, totals):
+            perplexities[i] = math.exp(total / count)
+    return perplexities
+
+
+def bench_shared_prefix(texts, model, tokenizer, min_prefix=32, max_length=1024, batch_size=8):
+    """Time and largest relative difference of prefix-sharing scoring against scoring every full document"""
+    start = time.perf_counter()
+    exact = batch_perplexities(texts, model, tokenizer, max_length, batch_size)
+    exact_seconds = time.perf_counter() - start
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    encodings = [tokenizer(text, truncation=True, max_length=max_length).input_ids for text in texts]
+    groups = group_shared_prefixes(encodings, min_prefix)
+    start = time.perf_counter()
+    shared = shared_prefix_perplexities(encodings, model, pad_token_id, min_prefix, batch_size)
+    shared_seconds = time.perf_counter() - start
+
+    saved = sum(prefix_length * (len(indices) - 1) for indices, prefix_length in groups if len(indices) > 1)
+    print(f"{len(texts)} documents in {len(groups)} prefix groups, {saved / sum(map(len, encodings)):.0%} of tokens "
+          f"shared; full {exact_seconds:.1f}s, shared prefix {shared_seconds:.1f}s "
+          f"({exact_seconds / shared_seconds:.1f}x), max relative difference "
+          f"{max(abs(a - b) / a for a, b in zip(exact, shared)):.2e}")
+
+
+def split_windows(num_tokens, window_size):
+    """(start, end) of consecutive windows; a window needs two tokens to predict anything"""
+    return [(start, min(start + window_size, num_tokens)) for start in range(0, num_tokens, window_size)
+            if min(start + window_size, num_tokens) - start >= 2]
+
+
+def window_loss(model, input_ids, start, end):
+    """Mean negative log-likelihood of the window and the number of tokens it predicts"""
+    return mean_token_loss(model, input_ids[:, start:end]), end - start - 1
+
+
+def _visit_order(num_windows, sampling, strata, rng):
+    """
+        Order to score windows in. 'stratified' first takes one random window from each of
+        `strata` equal slices of the document, so early estimates already span all of it
+    """
+    order = rng.permutation(num_windows)
+    if sampling == 'random':
+        return order
+    bounds = np.linspace(0, num_windows, min(strata, num_windows) + 1).astype(int)
+    first = [int(rng.integers(low, high)) for low, high in zip(bounds[:-1], bounds[1:])]
+    chosen = set(first)
+    return np.array(first + [i for i in order if i not in chosen])
+
+
+def _ratio_interval(losses, counts, num_windows, confidence):
+    """Token-weighted mean NLL of the sampled windows and the half-width of its confidence interval"""
+    losses = np.asarray(losses)
+    counts = np.asarray(counts, dtype=np.float64)
+    mean_nll = np.sum(losses * counts) / np.sum(counts)
+    m = len(losses)
+    if m < 2:
+        return mean_nll, math.inf
+    # Ratio estimator variance, with finite population correction since windows are drawn without replacement
+    residuals = counts * (losses - mean_nll)
+    variance = (1 - m / num_windows) * np.var(residuals, ddof=1) / (m * np.mean(counts) ** 2)
+    return mean_nll, stats.t.ppf((1 + confidence) / 2, m - 1) * math.sqrt(max(variance, 0.0))
+
+
+def _document_ids(text, tokenizer, token_ids=None):
+    """Token ids of the whole text as a (1, n) tensor; pre-tokenized ids (e.g. from a TokenCache) skip the tokenizer"""
+    if token_ids is None:
+        return tokenizer(text, return_tensors='pt').input_ids
+    return torch.tensor(np.asarray(token_ids, dtype=np.int64)).unsqueeze(0)
+
+
+def estimate_perplexity(text, model, tokenizer, window_size=256, confidence=0.95, relative_tolerance=0.05,
+                        min_windows=4, max_windows=None, sampling='stratified', seed=0, token_ids=None):
+    """
+        Approximate the perplexity of the whole text (scored in windows of window_size tokens)
+        from a sample of windows. Windows are scored until the confidence interval of the
+        perplexity is within relative_tolerance of the estimate, or max_windows were scored
+    """
+    input_ids = _document_ids(text, tokenizer, token_ids)
+    windows = split_windows(input_ids.shape[1], window_size)
+    if not windows:
+        return PerplexityEstimate(math.nan, math.nan, math.nan, 0, 0)
+
+    rng = np.random.default_rng(seed)
+    order = _visit_order(len(windows), sampling, min_windows, rng)
+    max_windows = len(windows) if max_windows is None else min(max_windows, len(windows))
+
+    losses, counts = [], []
+    mean_nll, half_width = math.nan, math.inf
+    for index in order[:max_windows]:
+        loss, count = window_loss(model, input_ids, *windows[index])
+        losses.append(loss)
+        counts.append(count)
+        mean_nll, half_width = _ratio_interval(losses, counts, len(windows), confidence)
+        if len(losses) >= min_windows and math.exp(half_width) - 1 <= relative_tolerance:
+            break
+
+    if len(losses) == len(windows):
+        half_width = 0.0
+    return PerplexityEstimate(math.exp(mean_nll), math.exp(mean_nll - half_width), math.exp(mean_nll + half_width),
+                              len(losses), len(windows))
+
+
+def windowed_perplexity(text, model, tokenizer, window_size=256, token_ids=None):
+    """Exact perplexity over every window, the quantity estimate_perplexity approximates"""
+    input_ids = _document_ids(text, tokenizer, token_ids)
+    losses, counts = zip(*[window_loss(model, input_ids, start, end)
+                           for start, end in split_windows(input_ids.shape[1], window_size)])
+    return math.exp(np.sum(np.array(losses) * np.array(counts)) / np.sum(counts))
+
+
+def bench_sampled_perplexity(texts, model, tokenizer, window_size=256, relative_tolerance=0.05, min_tokens=4096,
+                             reference=None):
+    """
+        Compare estimate_perplexity against the exact windowed value on documents of at least min_tokens,
+        and against reference(text) as well when given (e.g. the perplexity feature as main computes it)
+    """
+    rows = []
+    for text in texts:
+        if len(tokenizer(text).input_ids) < min_tokens:
+            continue
+        start = time.perf_counter()
+        exact = windowed_perplexity(text, model, tokenizer, window_size)
+        exact_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        estimate = estimate_perplexity(text, model, tokenizer, window_size, relative_tolerance=relative_tolerance)
+        estimate_seconds = time.perf_counter() - start
+
+        feature = reference(text) if reference is not None else math.nan
+        rows.append((abs(estimate.perplexity - exact) / exact, estimate.low <= exact <= estimate.high,
+                     exact_seconds / estimate_seconds, abs(estimate.perplexity - feature) / feature))
+        print(f"exact {exact:9.2f}  estimate {estimate.perplexity:9.2f} [{estimate.low:.2f}, {estimate.high:.2f}]  "
+              f"windows {estimate.windows_scored}/{estimate.windows_total}  speedup {rows[-1][2]:.1f}x"
+              + (f"  feature {feature:9.2f}" if reference is not None else ""))
+
+    if not rows:
+        print(f"No document has {min_tokens} tokens or more")
+        return
+    errors, covered, speedups, feature_errors = zip(*rows)
+    print(f"\n{len(rows)} documents: mean relative error {np.mean(errors):.2%}, max {np.max(errors):.2%}, "
+          f"interval coverage {np.mean(covered):.0%}, mean speedup {np.mean(speedups):.1f}x")
+    if reference is not None:
+        print(f"against the reference value: mean relative error {np.mean(feature_errors):.2%}, "
+              f"max {np.max(feature_errors):.2%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sampled perplexity against exact scoring")
+    parser.add_argument("directories", nargs='+')
+    parser.add_argument("--window-size", type=int, default=1024,
+                        help="tokens per window; the perplexity feature scores one window of 1024")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--min-tokens", type=int, default=4096)
+    parser.add_argument("--shared-prefix", type=int, metavar="MIN_TOKENS",
+                        help="benchmark shared-prefix batch scoring instead")
+    parser.add_argument("--packing", action="store_true", help="benchmark sequence packing of short texts instead")
+    args = parser.parse_args()
+
+    import main as aux_function
+    from token_cache import read_corpus
+
+    if args.packing:
+        bench_packing(read_corpus(args.directories), aux_function.gpt2_model, aux_function.gpt2_tokenizer)
+    elif args.shared_prefix:
+        bench_shared_prefix(read_corpus(args.directories), aux_function.gpt2_model, aux_function.gpt2_tokenizer,
+                            args.shared_prefix)
+    else:
+        def feature_perplexity(text):
+            return aux_function.calculate_perplexity(text, max_length=args.window_size)
+
+        bench_sampled_perplexity(read_corpus(args.directories), aux_function.gpt2_model, aux_function.gpt2_tokenizer,
+                                 args.window_size, args.tolerance, args.min_tokens, reference=feature_perplexity)
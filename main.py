@@ -1,4 +1,9 @@
+import hashlib
+import math
 import os
+from contextlib import nullcontext
+from functools import partial
+
 import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
@@ -6,18 +11,41 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
 import nltk
 from nltk.tokenize import word_tokenize, sent_tokenize
-from nltk.util import ngrams
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import GPT2TokenizerFast
 import pickle
-import textstat
+
+import byte_features
+import dedup
+import execution
+import lm_scoring
+import manifest
+import monitoring
+import ngram_stats
+import pipeline
+import readability
+import shared_weights
+import traffic
+from token_cache import load_token_cache
+
+# Partition the cores between feature extraction workers and the torch/BLAS threads inside each
+execution_config = execution.configure()
+
+# Records classify_text / classify_texts requests for `python traffic.py` when AI_DETECTION_TRAFFIC_LOG is set
+traffic_recorder = traffic.recorder_from_env()
 
 nltk.download('punkt')
 nltk.download('stopwords')
 
-# Load GPT-2 model for perplexity calculation
-gpt2_model = GPT2LMHeadModel.from_pretrained('gpt2')
-gpt2_tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+FEATURE_NAMES = ['readability', 'perplexity', 'lexical_density', 'avg_word_length', 'ngram_diversity',
+                 'avg_sentence_length']
+# Everything except the GPT-2 pass
+CHEAP_FEATURE_NAMES = [name for name in FEATURE_NAMES if name != 'perplexity']
+
+# Load GPT-2 model for perplexity calculation; mapped from the shared weights file when it has been exported,
+# so every worker process on the host uses one physical copy
+gpt2_model = shared_weights.load_gpt2('gpt2')
+gpt2_tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
 
 
 def read_files(directory):
@@ -29,29 +57,35 @@ def read_files(directory):
     return texts
 
 
-# def calculate_readability_score(text):
-#     sentences = sent_tokenize(text)
-#     words = word_tokenize(text)
-#     if not sentences or not words:
-#         return 0
-#     avg_sentence_length = len(words) / len(sentences)
-#     avg_syllables_per_word = sum(count_syllables(word) for word in words) / len(words)
-#     return 206.835 - 1.015 * avg_sentence_length - 84.6 * avg_syllables_per_word
-
 def calculate_readability_score(text):
-    return textstat.flesch_reading_ease(text)
+    return readability.flesch_reading_ease(text)
 
 
-def count_syllables(word):
-    return max(1, len([vowel for vowel in word if vowel in 'aeiou']))
+def calculate_perplexity(text, model=gpt2_model, tokenizer=gpt2_tokenizer, max_length=1024, token_ids=None,
+                         approximate=False):
+    if approximate:
+        return estimate_perplexity(text, model, tokenizer, max_length, token_ids).perplexity
 
+    if token_ids is None:
+        encodings = tokenizer(text, truncation=True, max_length=max_length, return_tensors='pt')
+        input_ids = encodings.input_ids[:, :max_length]
+    else:
+        # Pre-tokenized ids (e.g. from a TokenCache) skip the tokenizer entirely
+        input_ids = torch.tensor(np.asarray(token_ids[:max_length], dtype=np.int64)).unsqueeze(0)
+    # Loss computed chunk by chunk over the sequence instead of from the full logits tensor
+    return math.exp(lm_scoring.mean_token_loss(model, input_ids))
 
-def calculate_perplexity(text, model=gpt2_model, tokenizer=gpt2_tokenizer, max_length=1024):
-    encodings = tokenizer(text, truncation=True, max_length=max_length, return_tensors='pt')
-    input_ids = encodings.input_ids[:, :max_length]
-    with torch.no_grad():
-        outputs = model(input_ids, labels=input_ids)
-    return torch.exp(outputs.loss).item()
+
+def estimate_perplexity(text, model=gpt2_model, tokenizer=gpt2_tokenizer, max_length=1024, token_ids=None,
+                        **options):
+    """
+        lm_scoring.PerplexityEstimate (value and confidence interval) of the text scored in windows of
+        max_length tokens, from a sample of windows. A text of up to max_length tokens is one window,
+        scored exactly, so the value equals calculate_perplexity; longer texts are estimated over all
+        of it rather than only the first window
+    """
+    return lm_scoring.estimate_perplexity(text, model, tokenizer, window_size=max_length, token_ids=token_ids,
+                                          **options)
 
 
 def calculate_lexical_density(text):
@@ -67,8 +101,12 @@ def calculate_avg_word_length(text):
 
 def calculate_ngram_diversity(text, n=3):
     tokens = word_tokenize(text.lower())
-    n_grams = list(ngrams(tokens, n))
-    return len(set(n_grams)) / len(n_grams) if n_grams else 0
+    diversity, _ = ngram_stats.ngram_statistics(ngram_stats.encode_tokens(tokens), max_n=n)
+    return float(diversity[n - 1])
+
+
+def calculate_multi_order_ngram_features(text):
+    return ngram_stats.multi_order_features(word_tokenize(text.lower()))
 
 
 def calculate_avg_sentence_length(text):
@@ -77,38 +115,110 @@ def calculate_avg_sentence_length(text):
     return len(words) / len(sentences) if sentences else 0
 
 
-def get_text_features(text):
-    return [
-        calculate_readability_score(text),
-        calculate_perplexity(text),
-        calculate_lexical_density(text),
-        calculate_avg_word_length(text),
-        calculate_ngram_diversity(text),
-        calculate_avg_sentence_length(text)
-    ]
+# Extraction function of every feature column, so models trained on a subset only compute what they use
+FEATURE_FUNCTIONS = {
+    'readability': calculate_readability_score,
+    'perplexity': calculate_perplexity,
+    'lexical_density': calculate_lexical_density,
+    'avg_word_length': calculate_avg_word_length,
+    'ngram_diversity': calculate_ngram_diversity,
+    'avg_sentence_length': calculate_avg_sentence_length,
+}
+
+# Optional groups of extra features computed together in one pass, not part of the default FEATURE_NAMES.
+# A model trained with any of their names gets them from get_text_features like the other columns
+FEATURE_BLOCKS = {
+    'multi_order_ngrams': (ngram_stats.MULTI_ORDER_FEATURE_NAMES, calculate_multi_order_ngram_features),
+    'byte_stats': (byte_features.BYTE_FEATURE_NAMES, byte_features.byte_features),
+}
+_FEATURE_BLOCK_OF = {name: block for block, (names, _) in FEATURE_BLOCKS.items() for name in names}
+
+
+def get_text_features(text, token_cache=None, feature_names=None):
+    """Features of the text in feature_names order (all of FEATURE_NAMES by default)"""
+    features = []
+    block_values = {}
+    for name in feature_names or FEATURE_NAMES:
+        if name == 'perplexity':
+            token_ids = token_cache.get(text) if token_cache is not None else None
+            features.append(calculate_perplexity(text, token_ids=token_ids))
+        elif name in FEATURE_FUNCTIONS:
+            features.append(FEATURE_FUNCTIONS[name](text))
+        else:
+            if name not in block_values:
+                block_names, block_function = FEATURE_BLOCKS[_FEATURE_BLOCK_OF[name]]
+                block_values.update(zip(block_names, block_function(text)))
+            features.append(block_values[name])
+    return features
 
 
-def process_directory(directory, label):
-    texts = read_files(directory)
-    features = [get_text_features(text) for text in texts]
-    return pd.DataFrame(features,
-                        columns=['readability', 'perplexity', 'lexical_density', 'avg_word_length', 'ngram_diversity',
-                                 'avg_sentence_length']), pd.Series([label] * len(texts))
+def get_cheap_text_features(text):
+    """The features of get_text_features that don't need GPT-2, in CHEAP_FEATURE_NAMES order"""
+    return get_text_features(text, feature_names=CHEAP_FEATURE_NAMES)
 
 
-def train_and_save_model(ai_directory, human_directory, model_filename):
+def process_directory(directory, label, token_cache=None, dedup_index=None, feature_names=None):
+    feature_names = feature_names or FEATURE_NAMES
+    if execution_config.workers <= 1:
+        return pipelined_features(directory, label, token_cache, dedup_index, feature_names)
+
+    texts = read_files(directory)
+    if dedup_index is not None:
+        # Drop exact and near copies so resubmitted essays are not overweighted in training
+        texts = [text for i, text in enumerate(texts)
+                 if dedup_index.check(f"{directory}/{i}", text).kind is None]
+    features = execution.parallel_map(partial(get_text_features, token_cache=token_cache, feature_names=feature_names),
+                                      texts, execution_config)
+    return pd.DataFrame(features, columns=feature_names), pd.Series([label] * len(texts))
+
+
+def pipelined_features(directory, label, token_cache=None, dedup_index=None, feature_names=None):
+    """process_directory in one process, overlapping file reads, lexical features and GPT-2 batches"""
+    feature_names = feature_names or FEATURE_NAMES
+    paths = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith('.txt')]
+    keep = None
+    if dedup_index is not None:
+        keep = lambda path, text: dedup_index.check(path, text).kind is None
+    feature_pipeline = pipeline.FeaturePipeline(get_text_features, feature_names, gpt2_model, gpt2_tokenizer,
+                                                token_cache)
+    results = feature_pipeline.run(paths, keep)
+    feature_pipeline.report()
+    for result in results:
+        if result.error is not None:
+            raise result.error
+    return (pd.DataFrame([result.features for result in results], columns=feature_names),
+            pd.Series([label] * len(results)))
+
+
+def train_and_save_model(ai_directory, human_directory, model_filename, token_cache=None, dedup_index=None,
+                         feature_names=None):
     print("Processing AI-generated texts...")
-    ai_features, ai_labels = process_directory(ai_directory, 1)
+    ai_features, ai_labels = process_directory(ai_directory, 1, token_cache, dedup_index, feature_names)
 
     print("Processing human-written texts...")
-    human_features, human_labels = process_directory(human_directory, 0)
+    human_features, human_labels = process_directory(human_directory, 0, token_cache, dedup_index, feature_names)
+    if dedup_index is not None:
+        dedup_index.report()
 
     X = pd.concat([ai_features, human_features])
     y = pd.concat([ai_labels, human_labels])
+    return fit_and_save_model(X, y, model_filename)
+
 
+def new_model():
+    return LogisticRegression(max_iter=1000)
+
+
+def training_hyperparameters():
+    """Everything about the fit besides the data, for the manifest's skip-if-unchanged check"""
+    return {'model': type(new_model()).__name__, 'params': new_model().get_params(), 'test_size': 0.2,
+            'random_state': 42}
+
+
+def fit_and_save_model(X, y, model_filename):
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-    model = LogisticRegression(max_iter=1000)
+    model = new_model()
     model.fit(X_train, y_train)
 
     y_pred = model.predict(X_test)
@@ -135,13 +245,51 @@ def train_and_save_model(ai_directory, human_directory, model_filename):
     print("\nFeature Importances:")
     print(feature_importances)
 
-    with open(model_filename, 'wb') as file:
+    # Write next to the target and rename, so a serving process watching the file never reads half an artifact
+    with open(model_filename + '.tmp', 'wb') as file:
         pickle.dump((model, X.columns.tolist()), file)
+    os.replace(model_filename + '.tmp', model_filename)
     print(f"\nModel and feature names saved to {model_filename}")
+    # Training distribution of every feature, for drift monitoring of production traffic
+    monitoring.FeatureMonitor.from_rows(X.columns, X.values).save(monitoring.reference_path(model_filename))
 
     return model, X.columns.tolist()
 
 
+def retrain_incremental(ai_directory, human_directory, model_filename, manifest_filename=None, feature_names=None,
+                        token_cache=None, force=False):
+    """
+        train_and_save_model driven by a dataset manifest: features are extracted only for files
+        added or modified since the last run, and the fit is skipped when neither the files nor
+        the hyperparameters changed
+    """
+    feature_names = feature_names or FEATURE_NAMES
+    dataset = manifest.DatasetManifest(manifest_filename or model_filename + '.manifest.json', feature_names)
+
+    def extract(paths):
+        feature_pipeline = pipeline.FeaturePipeline(get_text_features, feature_names, gpt2_model, gpt2_tokenizer,
+                                                    token_cache)
+        results = feature_pipeline.run(paths)
+        for result in results:
+            if result.error is not None:
+                print(f"Error processing file {result.key}: {result.error}")
+        return {result.key: result.features for result in results if result.error is None}
+
+    dataset.refresh([(ai_directory, 1), (human_directory, 0)], extract,
+                    accept=lambda filename: filename.endswith('.txt'))
+    hyperparameters = training_hyperparameters()
+    if not force and dataset.is_fit_current(hyperparameters, model_filename):
+        dataset.save()
+        print(f"Dataset and hyperparameters unchanged, keeping {model_filename}")
+        return load_model(model_filename)
+
+    X, y, _ = dataset.training_set()
+    result = fit_and_save_model(pd.DataFrame(X, columns=feature_names), pd.Series(y), model_filename)
+    dataset.mark_fitted(hyperparameters)
+    dataset.save()
+    return result
+
+
 def load_model(filename):
     with open(filename, 'rb') as file:
         model, feature_names = pickle.load(file)
@@ -170,8 +318,37 @@ def interpret_contributions(feature_contributions, prediction):
     return interpreted_contributions
 
 
-def classify_text(text, model, feature_names):
-    features = get_text_features(text)
+def _recorded(entry, texts):
+    return traffic_recorder.record(entry, texts) if traffic_recorder is not None else nullcontext()
+
+
+def classify_text(text, model, feature_names, dedup_index=None, monitor=None):
+    with _recorded('classify_text', [text]):
+        return _classify_text(text, model, feature_names, dedup_index, monitor)
+
+
+def classify_texts(texts, model, feature_names, dedup_index=None, monitor=None):
+    """classify_text over a batch of texts, recorded as one request"""
+    with _recorded('classify_texts', texts):
+        return [_classify_text(text, model, feature_names, dedup_index, monitor) for text in texts]
+
+
+def _classify_text(text, model, feature_names, dedup_index=None, monitor=None):
+    if dedup_index is not None:
+        # Exact resubmissions reuse the earlier result instead of another GPT-2 pass
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        match = dedup_index.check(key, text)
+        if match.kind == dedup.EXACT and dedup_index.get_result(match.key) is not None:
+            return dedup_index.get_result(match.key)
+        result = _classify_text(text, model, feature_names, monitor=monitor)
+        # An exact copy indexed under another key without a result: store it there, check() did not index key
+        dedup_index.set_result(match.key if match.kind == dedup.EXACT else key, result)
+        return result
+
+    # Only the features the model was trained on are computed
+    features = get_text_features(text, feature_names=feature_names)
+    if monitor is not None:
+        monitor.update(features)
     features_array = np.array(features).reshape(1, -1)
     prediction = model.predict(features_array)[0]
     probability = model.predict_proba(features_array)[0][1]
@@ -185,7 +362,9 @@ if __name__ == "__main__":
     ai_directory = "./data/ai"
     human_directory = "./data/human_samples"
     model_filename = "ai_detection_model.pkl"
-    train_and_save_model(ai_directory, human_directory, model_filename)
+    # Built with `python token_cache.py cache/corpus ./data/ai ./data/human_samples`
+    token_cache = load_token_cache("cache/corpus")
+    train_and_save_model(ai_directory, human_directory, model_filename, token_cache, dedup.DedupIndex())
 
     loaded_model, feature_names = load_model(model_filename)
 
@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+Changes = namedtuple('Changes', ['added', 'modified', 'removed', 'unchanged'])
+
+# Bump when feature extraction code changes the values of existing columns, so cached features are re-extracted
+FEATURE_SCHEMA_VERSION = 1
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fit_signature(hyperparameters, feature_names, entries):
+    """Hash of everything a fit depends on: estimator parameters, feature columns and each file's content and label"""
+    state = {
+        'hyperparameters': hyperparameters,
+        'feature_names': list(feature_names),
+        'files': sorted((path, entry['sha1'], entry['label']) for path, entry in entries.items()),
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class DatasetManifest:
+    """
+        Path, size, mtime, content hash, label and extracted features of every training file,
+        saved as JSON. refresh() compares the folders with it, so only added or modified files
+        are extracted again; a file whose size and mtime are unchanged is not even read.
+        Cached features are only invalidated by a change of feature_names or FEATURE_SCHEMA_VERSION,
+        not by edits to the extraction code itself
+    """
+
+    def __init__(self, path, feature_names):
+        self.path = path
+        self.feature_names = list(feature_names)
+        self.files = {}
+        self.fit_signature = None
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                state = json.load(file)
+            # Features of another column layout or schema are useless; everything is extracted again
+            if state['feature_names'] == self.feature_names and \
+                    state.get('schema_version') == FEATURE_SCHEMA_VERSION:
+                self.files = state['files']
+                self.fit_signature = state.get('fit_signature')
+
+    def scan(self, labelled_directories, accept=None):
+        """Changes between the manifest and the files now in the (directory, label) folders"""
+        added, modified, unchanged = [], [], []
+        current = {}
+        for directory, label in labelled_directories:
+            for filename in sorted(os.listdir(directory)):
+                path = os.path.join(directory, filename)
+                if not os.path.isfile(path) or filename.startswith('.') or (accept and not accept(filename)):
+                    continue
+                stat = os.stat(path)
+                current[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'label': label}
+                entry = self.files.get(path)
+                if entry and entry['label'] == label and (entry['size'], entry['mtime_ns']) == \
+                        (stat.st_size, stat.st_mtime_ns):
+                    unchanged.append(path)
+                    continue
+                current[path]['sha1'] = file_hash(path)
+                if entry is None:
+                    added.append(path)
+                elif entry['sha1'] != current[path]['sha1'] or entry['label'] != label:
+                    modified.append(path)
+                else:
+                    # Touched but identical: only the mtime needs updating
+                    entry['mtime_ns'] = stat.st_mtime_ns
+                    unchanged.append(path)
+        self._current = current
+        return Changes(added, modified, sorted(set(self.files) - set(current)), unchanged)
+
+    def refresh(self, labelled_directories, extract, accept=None):
+        """
+            Scan the folders, call extract(paths) -> {path: features} for added and modified files
+            only and drop removed ones. Files extract leaves out (errors) are retried next time
+        """
+        changes = self.scan(labelled_directories, accept)
+        print(f"Dataset: {len(changes.added)} added, {len(changes.modified)} modified, {len(changes.removed)} removed, "
+              f"{len(changes.unchanged)} unchanged")
+        for path in changes.removed:
+            del self.files[path]
+        changed = changes.added + changes.modified
+        features = extract(changed) if changed else {}
+        for path in changed:
+            if path in features:
+                self.files[path] = {**self._current[path], 'features': list(map(float, features[path]))}
+            else:
+                self.files.pop(path, None)
+        return changes
+
+    def training_set(self):
+        """X, y and paths of every file in path order, the same set a full retrain of the folders uses"""
+        labels = {}
+        for entry in self.files.values():
+            labels.setdefault(entry['sha1'], set()).add(entry['label'])
+        conflicts = sum(len(file_labels) > 1 for file_labels in labels.values())
+        if conflicts:
+            print(f"Warning: {conflicts} distinct texts appear under more than one label")
+
+        paths = sorted(self.files)
+        return [self.files[path]['features'] for path in paths], [self.files[path]['label'] for path in paths], paths
+
+    def is_fit_current(self, hyperparameters, model_filename):
+        return os.path.exists(model_filename) and \
+            self.fit_signature == fit_signature(hyperparameters, self.feature_names, self.files)
+
+    def mark_fitted(self, hyperparameters):
+        self.fit_signature = fit_signature(hyperparameters, self.feature_names, self.files)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump({'schema_version': FEATURE_SCHEMA_VERSION, 'feature_names': self.feature_names,
+                       'fit_signature': self.fit_signature, 'files': self.files}, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrain the detector, extracting features only for changed files")
+    parser.add_argument("--ai", default="./data/ai")
+    parser.add_argument("--human", default="./data/human_samples")
+    parser.add_argument("--model", default="ai_detection_model.pkl")
+    parser.add_argument("--manifest", help="defaults to <model>.manifest.json")
+    parser.add_argument("--force", action="store_true", help="fit even when nothing changed")
+    args = parser.parse_args()
+
+    import main as aux_function
+
+    aux_function.retrain_incremental(args.ai, args.human, args.model, args.manifest, force=args.force)
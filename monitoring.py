@@ -0,0 +1,286 @@
+import argparse
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+# Population stability index above which a feature counts as drifted (the usual "significant shift" level)
+PSI_THRESHOLD = 0.2
+
+
+def reference_path(model_filename):
+    """Where train_and_save_model stores the training-time sketch next to a model artifact"""
+    return model_filename + '.monitor.json'
+
+
+class RunningMoments:
+    """Count, mean, variance, min and max in O(1) memory; merges exactly across processes"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.count:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+            self.count = count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, state):
+        moments = cls()
+        moments.__dict__.update(state)
+        return moments
+
+
+class QuantileDigest:
+    """
+        Merging t-digest: values are summarized by at most about 2 x compression weighted
+        centroids, small near the tails, so quantiles and the CDF stay accurate at any volume
+    """
+
+    def __init__(self, compression=100, buffer_size=500):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def add(self, value):
+        self._buffer.append(value)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._compress(np.concatenate([self.means, self._buffer]),
+                           np.concatenate([self.weights, np.ones(len(self._buffer))]))
+            self._buffer = []
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        merged_means, merged_weights = [], []
+        mean, weight = means[0], weights[0]
+        cumulative = 0.0
+        lower = self._scale(0.0)
+        for next_mean, next_weight in zip(means[1:], weights[1:]):
+            if self._scale((cumulative + weight + next_weight) / total) - lower <= 1:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                merged_means.append(mean)
+                merged_weights.append(weight)
+                cumulative += weight
+                lower = self._scale(cumulative / total)
+                mean, weight = next_mean, next_weight
+        merged_means.append(mean)
+        merged_weights.append(weight)
+        self.means, self.weights = np.array(merged_means), np.array(merged_weights)
+
+    @property
+    def count(self):
+        return self.weights.sum() + len(self._buffer)
+
+    def _knots(self):
+        """Cumulative weight at each centroid's centre, pinned to min at 0 and max at the total"""
+        self._flush()
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return np.concatenate([[0.0], centers, [total]]), np.concatenate([[self.min], self.means, [self.max]]), total
+
+    def quantile(self, q):
+        if not self.count:
+            return math.nan
+        positions, values, total = self._knots()
+        quantiles = np.interp(np.asarray(q) * total, positions, values)
+        return float(quantiles) if np.ndim(q) == 0 else quantiles
+
+    def cdf(self, x):
+        if not self.count:
+            return np.full(np.shape(x), math.nan)
+        positions, values, total = self._knots()
+        return np.interp(x, values, positions) / total
+
+    def merge(self, other):
+        self._flush()
+        other._flush()
+        if len(other.means):
+            self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        self._flush()
+        return {'compression': self.compression, 'means': self.means.tolist(), 'weights': self.weights.tolist(),
+                'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, state):
+        digest = cls(state['compression'])
+        digest.means, digest.weights = np.array(state['means']), np.array(state['weights'])
+        digest.min, digest.max = state['min'], state['max']
+        return digest
+
+
+def drift_metrics(reference, current, bins=10):
+    """
+        Population stability index over the reference's quantile bins, the largest CDF gap
+        (Kolmogorov-Smirnov statistic) and the mean shift in reference standard deviations.
+        reference and current are (RunningMoments, QuantileDigest) pairs
+    """
+    (reference_moments, reference_digest), (current_moments, current_digest) = reference, current
+    edges = np.unique(reference_digest.quantile(np.linspace(0, 1, bins + 1)[1:-1]))
+    expected = np.diff(np.concatenate([[0.0], reference_digest.cdf(edges), [1.0]]))
+    actual = np.diff(np.concatenate([[0.0], current_digest.cdf(edges), [1.0]]))
+    expected, actual = np.clip(expected, 1e-4, None), np.clip(actual, 1e-4, None)
+    psi = float(np.sum((actual - expected) * np.log(actual / expected)))
+
+    grid = np.concatenate([reference_digest.quantile(np.linspace(0.01, 0.99, 99)),
+                           current_digest.quantile(np.linspace(0.01, 0.99, 99))])
+    ks = float(np.max(np.abs(reference_digest.cdf(grid) - current_digest.cdf(grid))))
+
+    std = reference_moments.std or 1.0
+    return {'psi': psi, 'ks': ks, 'mean_shift': (current_moments.mean - reference_moments.mean) / std,
+            'count': current_moments.count, 'drifted': psi > PSI_THRESHOLD}
+
+
+class FeatureMonitor:
+    """
+        Streaming sketches (moments plus a quantile digest) of each feature column. Memory per
+        feature is constant, monitors from several processes merge into one, and a monitor
+        built from the training rows serves as the reference new traffic is compared against
+    """
+
+    def __init__(self, feature_names, compression=100):
+        self.feature_names = list(feature_names)
+        self.sketches = {name: (RunningMoments(), QuantileDigest(compression)) for name in self.feature_names}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, feature_names, rows, compression=100):
+        monitor = cls(feature_names, compression)
+        for row in rows:
+            monitor.update(row)
+        return monitor
+
+    def update(self, features):
+        """Add one feature vector, in feature_names order; NaN/inf values are skipped"""
+        with self._lock:
+            for name, value in zip(self.feature_names, features):
+                value = float(value)
+                if math.isfinite(value):
+                    moments, digest = self.sketches[name]
+                    moments.add(value)
+                    digest.add(value)
+
+    def merge(self, other):
+        with self._lock:
+            for name in self.feature_names:
+                if name in other.sketches:
+                    moments, digest = self.sketches[name]
+                    other_moments, other_digest = other.sketches[name]
+                    moments.merge(other_moments)
+                    digest.merge(other_digest)
+        return self
+
+    def compare(self, reference):
+        """drift_metrics of every feature the reference also tracks"""
+        return {name: drift_metrics(reference.sketches[name], self.sketches[name])
+                for name in self.feature_names
+                if name in reference.sketches and self.sketches[name][0].count and reference.sketches[name][0].count}
+
+    def to_dict(self):
+        with self._lock:
+            return {'feature_names': self.feature_names,
+                    'sketches': {name: {'moments': moments.to_dict(), 'digest': digest.to_dict()}
+                                 for name, (moments, digest) in self.sketches.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        monitor = cls(state['feature_names'])
+        monitor.sketches = {name: (RunningMoments.from_dict(sketch['moments']),
+                                   QuantileDigest.from_dict(sketch['digest']))
+                            for name, sketch in state['sketches'].items()}
+        return monitor
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(path + '.tmp', path)
+
+
+def load_monitor(path):
+    """The FeatureMonitor saved at path, or None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return FeatureMonitor.from_dict(json.load(file))
+
+
+def merge_monitors(paths):
+    """One monitor from the sketches several worker processes saved, or None if none of them exists yet"""
+    monitors = [monitor for monitor in map(load_monitor, paths) if monitor is not None]
+    if not monitors:
+        return None
+    merged = monitors[0]
+    for monitor in monitors[1:]:
+        merged.merge(monitor)
+    return merged
+
+
+def print_drift_report(drift):
+    print(f"{'feature':<22}{'count':>8}{'PSI':>8}{'KS':>7}{'shift':>8}")
+    for name, metrics in drift.items():
+        flag = "  DRIFT" if metrics['drifted'] else ""
+        print(f"{name:<22}{metrics['count']:>8}{metrics['psi']:>8.3f}{metrics['ks']:>7.3f}"
+              f"{metrics['mean_shift']:>7.2f}σ{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare production feature sketches against the training reference")
+    parser.add_argument("model_filename")
+    parser.add_argument("sketches", nargs='+', help="monitor files saved by serving processes")
+    args = parser.parse_args()
+
+    reference = load_monitor(reference_path(args.model_filename))
+    if reference is None:
+        raise SystemExit(f"No reference sketch at {reference_path(args.model_filename)}; retrain to create one")
+    production = merge_monitors(args.sketches)
+    if production is None:
+        raise SystemExit(f"No sketch saved yet at {', '.join(args.sketches)}")
+    print_drift_report(production.compare(reference))
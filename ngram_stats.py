@@ -0,0 +1,50 @@
+import numpy as np
+
+MAX_ORDER = 5
+MULTI_ORDER_FEATURE_NAMES = ([f'ngram_diversity_{n}' for n in range(1, MAX_ORDER + 1)] +
+                             [f'ngram_repetition_{n}' for n in range(1, MAX_ORDER + 1)])
+
+# Odd multiplier of the rolling hash; arithmetic wraps modulo 2**64
+_HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+_rng = np.random.default_rng(20240917)
+
+
+def encode_tokens(tokens):
+    """Map tokens to random 64-bit codes, one per distinct token of the document"""
+    vocabulary = {}
+    ids = np.fromiter((vocabulary.setdefault(token, len(vocabulary)) for token in tokens), dtype=np.int64,
+                      count=len(tokens))
+    codes = _rng.integers(0, 2 ** 63, size=len(vocabulary), dtype=np.uint64) | np.uint64(1)
+    return codes[ids]
+
+
+def ngram_statistics(codes, max_n=MAX_ORDER):
+    """
+        Diversity (distinct / total n-grams) and repetition rate (share of n-gram occurrences
+        whose n-gram occurs more than once) for n = 1..max_n, from one rolling pass over the
+        encoded tokens. Orders longer than the text score 0
+    """
+    diversity = np.zeros(max_n)
+    repetition = np.zeros(max_n)
+    hashes = codes
+    with np.errstate(over='ignore'):
+        for n in range(1, max_n + 1):
+            if n > 1:
+                # Extend every (n-1)-gram hash by the token that follows it
+                hashes = hashes[:-1] * _HASH_BASE + codes[n - 1:]
+            if not len(hashes):
+                break
+            ordered = np.sort(hashes)
+            same_as_next = ordered[1:] == ordered[:-1]
+            repeated = np.zeros(len(ordered), dtype=bool)
+            repeated[1:] = same_as_next
+            repeated[:-1] |= same_as_next
+            diversity[n - 1] = (len(ordered) - np.count_nonzero(same_as_next)) / len(ordered)
+            repetition[n - 1] = np.count_nonzero(repeated) / len(ordered)
+    return diversity, repetition
+
+
+def multi_order_features(tokens, max_n=MAX_ORDER):
+    """Diversities then repetition rates for n = 1..max_n, in MULTI_ORDER_FEATURE_NAMES order"""
+    diversity, repetition = ngram_statistics(encode_tokens(tokens), max_n)
+    return diversity.tolist() + repetition.tolist()
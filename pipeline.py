@@ -0,0 +1,187 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import lm_scoring
+
+PipelineResult = namedtuple('PipelineResult', ['key', 'features', 'error'])
+
+_DONE = object()
+
+
+class StageStats:
+    """Time a stage spent working, waiting for input and blocked on a full output queue"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def get(self, source):
+        start = time.perf_counter()
+        item = source.get()
+        self.starved += time.perf_counter() - start
+        return item
+
+    def put(self, sink, item):
+        start = time.perf_counter()
+        sink.put(item)
+        self.blocked += time.perf_counter() - start
+
+
+class FeaturePipeline:
+    """
+        get_text_features over many files as overlapping stages joined by bounded queues:
+        a reader thread prefetching files, cpu_workers threads computing the lexical features
+        and GPT-2 token ids, and one LM thread scoring perplexity for batches of documents
+        (sharing the key/values of common prefixes with min_shared_prefix). A full queue blocks
+        the stage feeding it, so at most about 2 x queue_size documents are in flight whatever
+        the corpus size
+    """
+
+    def __init__(self, feature_function, feature_names, model, tokenizer, token_cache=None, max_length=1024,
+                 lm_batch_size=8, queue_size=32, cpu_workers=1, min_shared_prefix=None):
+        self.feature_function = feature_function
+        self.feature_names = list(feature_names)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.token_cache = token_cache
+        self.max_length = max_length
+        self.lm_batch_size = lm_batch_size
+        self.queue_size = queue_size
+        self.cpu_workers = cpu_workers
+        self.min_shared_prefix = min_shared_prefix
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.stats = []
+        self.wall_time = 0.0
+
+    def _read(self, paths, keep, sink, stats):
+        for index, path in enumerate(paths):
+            start = time.perf_counter()
+            try:
+                with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+                    text = file.read()
+                item = (index, path, text, None) if keep is None or keep(path, text) else None
+            except Exception as e:
+                item = (index, path, None, e)
+            stats.busy += time.perf_counter() - start
+            stats.items += 1
+            if item is not None:
+                stats.put(sink, item)
+        for _ in range(self.cpu_workers):
+            stats.put(sink, _DONE)
+
+    def _lexical(self, extra_features, source, sink, stats):
+        cpu_names = [name for name in self.feature_names if name != 'perplexity']
+        while True:
+            item = stats.get(source)
+            if item is _DONE:
+                stats.put(sink, _DONE)
+                return
+            index, path, text, error = item
+            start = time.perf_counter()
+            features = token_ids = None
+            if error is None:
+                try:
+                    features = self.feature_function(text, feature_names=cpu_names) if cpu_names else []
+                    if extra_features is not None:
+                        features += extra_features(path, text)
+                    if 'perplexity' in self.feature_names:
+                        token_ids = self._token_ids(text)
+                except Exception as e:
+                    error = e
+            stats.busy += time.perf_counter() - start
+            stats.items += 1
+            stats.put(sink, (index, path, features, token_ids, error))
+
+    def _token_ids(self, text):
+        token_ids = self.token_cache.get(text) if self.token_cache is not None else None
+        if token_ids is None:
+            token_ids = self.tokenizer(text, truncation=True, max_length=self.max_length).input_ids
+        return token_ids[:self.max_length]
+
+    def _lm(self, source, results, stats):
+        finished = 0
+        while finished < self.cpu_workers:
+            batch = []
+            item = stats.get(source)
+            # Take whatever else is already queued instead of waiting for a full batch
+            while True:
+                if item is _DONE:
+                    finished += 1
+                else:
+                    batch.append(item)
+                if len(batch) == self.lm_batch_size:
+                    break
+                try:
+                    item = source.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                start = time.perf_counter()
+                self._score(batch, results)
+                stats.busy += time.perf_counter() - start
+                stats.items += len(batch)
+
+    def _score(self, batch, results):
+        scored = [item for item in batch if item[4] is None and item[3] is not None]
+        perplexities = {}
+        if scored:
+            encodings = [item[3] for item in scored]
+            try:
+                if self.min_shared_prefix:
+                    values = lm_scoring.shared_prefix_perplexities(encodings, self.model, self.pad_token_id,
+                                                                   self.min_shared_prefix, self.lm_batch_size)
+                else:
+                    values = lm_scoring.perplexities_from_ids(encodings, self.model, self.pad_token_id)
+                perplexities = dict(zip((item[0] for item in scored), values))
+            except Exception as e:
+                failed = {item[0] for item in scored}
+                batch = [item[:4] + (e,) if item[0] in failed else item for item in batch]
+
+        for index, path, features, _, error in batch:
+            if error is None and index in perplexities:
+                features.insert(self.feature_names.index('perplexity'), perplexities[index])
+            results[index] = PipelineResult(path, None if error else features, error)
+
+    def run(self, paths, keep=None, extra_features=None):
+        """
+            PipelineResults in path order. keep(path, text) runs on the reader thread and drops
+            the file when it returns False; extra_features(path, text) runs on the CPU stage and
+            returns columns appended after feature_names
+        """
+        to_cpu = queue.Queue(self.queue_size)
+        to_lm = queue.Queue(self.queue_size)
+        results = {}
+        reader, lm = StageStats('read'), StageStats('lm')
+        lexical = [StageStats(f'cpu-{i}' if self.cpu_workers > 1 else 'cpu') for i in range(self.cpu_workers)]
+        self.stats = [reader] + lexical + [lm]
+
+        threads = [threading.Thread(target=self._read, args=(list(paths), keep, to_cpu, reader), daemon=True)]
+        threads += [threading.Thread(target=self._lexical, args=(extra_features, to_cpu, to_lm, stats), daemon=True)
+                    for stats in lexical]
+        threads.append(threading.Thread(target=self._lm, args=(to_lm, results, lm), daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_time = time.perf_counter() - start
+        return [results[index] for index in sorted(results)]
+
+    def report(self):
+        """Per-stage utilization of the last run; the busiest stage is the bottleneck"""
+        print_stage_report(self.stats, self.wall_time)
+
+
+def print_stage_report(stage_stats, wall_time):
+    print(f"{'stage':<8}{'items':>8}{'busy':>9}{'starved':>10}{'blocked':>10}{'util':>7}")
+    for stats in stage_stats:
+        print(f"{stats.name:<8}{stats.items:>8}{stats.busy:>8.1f}s{stats.starved:>9.1f}s{stats.blocked:>9.1f}s"
+              f"{stats.busy / max(wall_time, 1e-9):>7.0%}")
+    bottleneck = max(stage_stats, key=lambda stats: stats.busy)
+    print(f"wall {wall_time:.1f}s, bottleneck: {bottleneck.name}")
@@ -0,0 +1,131 @@
+import math
+import os
+import re
+import sys
+from functools import lru_cache
+
+import pyphen
+
+# Bounded per-word-type cache; a corpus vocabulary rarely exceeds this.
+SYLLABLE_CACHE_SIZE = 65536
+
+_hyphenator = pyphen.Pyphen(lang='en_US')
+
+_punctuation_re = re.compile(r"[^\w\s]")
+_sentence_re = re.compile(r'\b[^.!?]+[.!?]*', re.UNICODE)
+
+
+def _legacy_round(number, points):
+    """Round half away from zero, the way textstat rounds its outputs"""
+    p = 10 ** points
+    return float(math.floor((number * p) + math.copysign(0.5, number))) / p
+
+
+@lru_cache(maxsize=SYLLABLE_CACHE_SIZE)
+def count_syllables(word):
+    """Syllable count of a single lowercase, punctuation-free word"""
+    return len(_hyphenator.positions(word)) + 1
+
+
+def lexicon(text):
+    """Split the text into the words textstat counts (lowercased, punctuation removed)"""
+    return _punctuation_re.sub('', text.lower()).split()
+
+
+def sentence_counts(text):
+    """Regex sentences of the text and how many of them are fragments of two words or fewer"""
+    sentences = _sentence_re.findall(text)
+    ignored = sum(1 for sentence in sentences if len(_punctuation_re.sub('', sentence).split()) <= 2)
+    return len(sentences), ignored
+
+
+def sentence_count(text):
+    """Count sentences, ignoring fragments of two words or fewer (same rule as textstat)"""
+    sentences, ignored = sentence_counts(text)
+    return max(1, sentences - ignored)
+
+
+def syllable_counts(words):
+    """Total syllables of the words and how many words have three or more"""
+    syllables = 0
+    complex_words = 0
+    for word in words:
+        word_syllables = count_syllables(word)
+        syllables += word_syllables
+        if word_syllables >= 3:
+            complex_words += 1
+    return syllables, complex_words
+
+
+def scores_from_counts(num_words, syllables, complex_words, num_sentences):
+    """The readability_scores formulas on running totals, for text that is consumed in pieces"""
+    # Empty texts score the formula constants, as textstat does
+    avg_sentence_length = _legacy_round(num_words / num_sentences, 1)
+    avg_syllables_per_word = _legacy_round(syllables / num_words, 1) if num_words else 0.0
+    complex_word_percentage = 100 * complex_words / num_words if num_words else 0.0
+
+    # Gunning Fog counts every word of three or more syllables as complex; textstat
+    # additionally exempts Dale-Chall easy words, so that index is not expected to match it.
+    return {
+        'flesch_reading_ease': _legacy_round(
+            206.835 - 1.015 * avg_sentence_length - 84.6 * avg_syllables_per_word, 2),
+        'flesch_kincaid_grade': _legacy_round(
+            0.39 * avg_sentence_length + 11.8 * avg_syllables_per_word - 15.59, 1),
+        'gunning_fog': _legacy_round(
+            0.4 * (avg_sentence_length + complex_word_percentage), 2),
+    }
+
+
+def readability_scores(words, num_sentences):
+    """
+        Compute Flesch reading ease, Flesch-Kincaid grade and Gunning Fog in one pass
+        over already tokenized words (as returned by `lexicon`) and a sentence count
+    """
+    return scores_from_counts(len(words), *syllable_counts(words), num_sentences)
+
+
+def text_readability_scores(text):
+    return readability_scores(lexicon(text), sentence_count(text))
+
+
+def flesch_reading_ease(text):
+    return text_readability_scores(text)['flesch_reading_ease']
+
+
+def check_textstat_parity(directories, tolerance=0.01):
+    """
+        Compare the engine against textstat on every .txt file in the given directories.
+        Returns the list of (path, index, ours, textstat) mismatches
+    """
+    import textstat
+
+    reference = {
+        'flesch_reading_ease': textstat.flesch_reading_ease,
+        'flesch_kincaid_grade': textstat.flesch_kincaid_grade,
+    }
+    mismatches = []
+    checked = 0
+    for directory in directories:
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.txt'):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+                text = file.read()
+            scores = text_readability_scores(text)
+            for index, textstat_function in reference.items():
+                expected = textstat_function(text)
+                if abs(scores[index] - expected) > tolerance:
+                    mismatches.append((path, index, scores[index], expected))
+            checked += 1
+
+    print(f"Checked {checked} files against textstat, {len(mismatches)} mismatches")
+    for path, index, ours, expected in mismatches:
+        print(f"  {path}: {index} {ours} != {expected}")
+    print(f"Syllable cache: {count_syllables.cache_info()}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    directories = sys.argv[1:] or ["./data/ai", "./data/human_samples"]
+    sys.exit(1 if check_textstat_parity(directories) else 0)
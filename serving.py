@@ -0,0 +1,186 @@
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main as aux_function
+import monitoring
+
+WARMUP_TEXT = ("The solar system is a vast expanse centered around our Sun. It consists of eight planets "
+               "orbiting the Sun at varying distances, accompanied by moons, asteroids and comets.")
+
+
+def known_feature_names():
+    names = set(aux_function.FEATURE_FUNCTIONS)
+    for block_names, _ in aux_function.FEATURE_BLOCKS.values():
+        names.update(block_names)
+    return names
+
+
+def validate_model(model, feature_names):
+    """Raise ValueError unless the model can serve classify_text with features main knows how to compute"""
+    unknown = [name for name in feature_names if name not in known_feature_names()]
+    if unknown:
+        raise ValueError(f"unknown features {unknown}")
+    if getattr(model, 'n_features_in_', len(feature_names)) != len(feature_names):
+        raise ValueError(f"model expects {model.n_features_in_} features, artifact lists {len(feature_names)}")
+
+    # Unrecorded, so warmups on start and every swap stay out of the traffic replay log
+    prediction, probability, _ = aux_function._classify_text(WARMUP_TEXT, model, feature_names)
+    if not 0 <= probability <= 1 or math.isnan(probability):
+        raise ValueError(f"warmup prediction returned probability {probability}")
+
+
+class ModelServer:
+    """
+        Serves classify_text from a model artifact that is replaced without a restart. A watcher
+        thread loads and validates a new artifact in the background and then swaps it in with a
+        single reference assignment; requests already running keep the model they started with.
+        GPT-2 and NLTK live in main and stay loaded across swaps. Each model version has its own
+        FeatureMonitor of the traffic it served, saved to monitor_path on every poll
+    """
+
+    def __init__(self, model_filename, poll_interval=5, monitor_path=None):
+        self.model_filename = model_filename
+        self.poll_interval = poll_interval
+        self.monitor_path = monitor_path
+        self.version = 0
+        self._signature = self._artifact_signature()
+        model, feature_names = aux_function.load_model(model_filename)
+        validate_model(model, feature_names)
+        self.reference = monitoring.load_monitor(monitoring.reference_path(model_filename))
+        self._current = (model, feature_names, self.version, monitoring.FeatureMonitor(feature_names))
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def _artifact_signature(self):
+        try:
+            stat = os.stat(self.model_filename)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def classify(self, text):
+        """classify_text on the model current when the request starts; also returns that model's version"""
+        model, feature_names, version, monitor = self._current
+        return aux_function.classify_text(text, model, feature_names, monitor=monitor) + (version,)
+
+    def classify_batch(self, texts):
+        """classify_texts on one model version, which is returned alongside the results"""
+        model, feature_names, version, monitor = self._current
+        return aux_function.classify_texts(texts, model, feature_names, monitor=monitor), version
+
+    @property
+    def monitor(self):
+        return self._current[3]
+
+    def drift(self):
+        """drift_metrics of the traffic served by the current model against its training reference"""
+        return self.monitor.compare(self.reference) if self.reference is not None else {}
+
+    def reload_if_changed(self):
+        """Load, validate and swap in the artifact if it changed on disk. Returns True on a swap"""
+        signature = self._artifact_signature()
+        if signature is None or signature == self._signature:
+            return False
+        # Remember the signature either way, so a rejected artifact is only retried once it changes again
+        self._signature = signature
+        try:
+            model, feature_names = aux_function.load_model(self.model_filename)
+            validate_model(model, feature_names)
+        except Exception as e:
+            print(f"Rejected new model artifact {self.model_filename}: {e}")
+            return False
+
+        self.version += 1
+        self.reference = monitoring.load_monitor(monitoring.reference_path(self.model_filename))
+        self._current = (model, feature_names, self.version, monitoring.FeatureMonitor(feature_names))
+        print(f"Switched to model version {self.version} ({len(feature_names)} features)")
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            if self.monitor_path is not None:
+                self.monitor.save(self.monitor_path)
+            self.reload_if_changed()
+
+    def start(self):
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+
+
+def _result_json(result, version):
+    prediction, probability, _ = result
+    return {'prediction': prediction, 'probability': float(probability), 'model_version': version}
+
+
+def serve_http(server, port, host='127.0.0.1'):
+    """
+        POST {"text": ...} or {"texts": [...]} as JSON to any path; answers with the predictions as JSON.
+        There is no authentication, so it listens on localhost unless another host is given
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if 'texts' in body:
+                    results, version = server.classify_batch(body['texts'])
+                    response = {'results': [_result_json(result, version) for result in results]}
+                else:
+                    result = server.classify(body['text'])
+                    response = _result_json(result[:3], result[3])
+                status = 200
+            except (ValueError, KeyError, TypeError) as e:
+                response, status = {'error': repr(e)}, 400
+            except Exception as e:
+                response, status = {'error': repr(e)}, 500
+            payload = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving on http://{host}:{port}/")
+    http_server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify texts from stdin (one per line) or HTTP, "
+                                                 "with hot model reloads")
+    parser.add_argument("model_filename", nargs='?', default="ai_detection_model.pkl")
+    parser.add_argument("--poll-interval", type=float, default=5)
+    parser.add_argument("--monitor-path", help="save feature sketches here for `python monitoring.py`")
+    parser.add_argument("--http", type=int, metavar="PORT", help="serve JSON over HTTP instead of reading stdin")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="HTTP bind address; the endpoint is unauthenticated, pass 0.0.0.0 only to expose it")
+    args = parser.parse_args()
+
+    server = ModelServer(args.model_filename, args.poll_interval, args.monitor_path).start()
+    try:
+        if args.http:
+            serve_http(server, args.http, args.host)
+        for line in sys.stdin:
+            if line.strip():
+                start = time.perf_counter()
+                prediction, probability, _, version = server.classify(line.strip())
+                print(f"{prediction}\t{probability:.4f}\tmodel v{version}\t{time.perf_counter() - start:.3f}s",
+                      flush=True)
+    finally:
+        server.stop()
+        monitoring.print_drift_report(server.drift())
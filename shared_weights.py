@@ -0,0 +1,127 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+# `python shared_weights.py export` writes the weights here; main maps them instead of loading a private copy
+SHARED_WEIGHTS_DIR = os.getenv("AI_DETECTION_GPT2_WEIGHTS", "cache/gpt2-mmap")
+WEIGHTS_FILE = "weights.pt"
+CONFIG_FILE = "config.json"
+
+
+def export_weights(model, directory=SHARED_WEIGHTS_DIR):
+    """
+        Save every parameter and buffer (non-persistent ones included) as one torch file that
+        load_shared_model can memory-map. The LM head is tied to the token embeddings and not stored
+    """
+    os.makedirs(directory, exist_ok=True)
+    tensors = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+    tensors = {name: tensor.detach().contiguous() for name, tensor in tensors.items() if name != 'lm_head.weight'}
+    torch.save(tensors, os.path.join(directory, WEIGHTS_FILE + '.tmp'))
+    os.replace(os.path.join(directory, WEIGHTS_FILE + '.tmp'), os.path.join(directory, WEIGHTS_FILE))
+    model.config.to_json_file(os.path.join(directory, CONFIG_FILE))
+    print(f"GPT-2 weights exported to {directory}")
+
+
+def _assign(model, name, tensor):
+    module_name, _, attribute = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if attribute in module._parameters:
+        module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attribute] = tensor
+
+
+def load_shared_model(directory=SHARED_WEIGHTS_DIR):
+    """
+        GPT-2 whose tensors are views of the memory-mapped weights file. Nothing is deserialized
+        or copied: pages are read in on first use and the page cache holds one physical copy for
+        every process on the host that maps the same file
+    """
+    config = GPT2Config.from_json_file(os.path.join(directory, CONFIG_FILE))
+    # Build the modules without allocating weights, then point them at the mapped tensors
+    with torch.device('meta'):
+        model = GPT2LMHeadModel(config)
+    tensors = torch.load(os.path.join(directory, WEIGHTS_FILE), mmap=True, weights_only=True)
+    for name, tensor in tensors.items():
+        _assign(model, name, tensor)
+    model.tie_weights()
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{directory} has no weights for {missing}")
+    return model.eval()
+
+
+def load_gpt2(name='gpt2', directory=SHARED_WEIGHTS_DIR):
+    """The memory-mapped export when there is one, otherwise a private copy from from_pretrained"""
+    if os.path.exists(os.path.join(directory, WEIGHTS_FILE)):
+        return load_shared_model(directory)
+    return GPT2LMHeadModel.from_pretrained(name)
+
+
+def memory_usage_mb():
+    """RSS, PSS (shared pages split between the processes mapping them) and private memory of this process"""
+    usage = {}
+    with open('/proc/self/smaps_rollup', 'r') as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                usage[fields[0].rstrip(':')] = int(fields[1]) / 1024
+    return {'rss_mb': usage['Rss'], 'pss_mb': usage['Pss'],
+            'private_mb': usage['Private_Clean'] + usage['Private_Dirty']}
+
+
+def _measure_worker(mode, directory, ready, release, results):
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    model = load_shared_model(directory) if mode == 'mmap' else GPT2LMHeadModel.from_pretrained('gpt2').eval()
+    load_seconds = time.perf_counter() - start
+    with torch.no_grad():
+        model(torch.arange(64).unsqueeze(0) % model.config.vocab_size)
+    # Measure while every worker is alive, so shared pages are split between all of them
+    ready.wait()
+    results.put({'pid': os.getpid(), 'load_seconds': load_seconds, **memory_usage_mb()})
+    release.wait()
+
+
+def measure_workers(workers=4, mode='mmap', directory=SHARED_WEIGHTS_DIR):
+    """Start `workers` fresh processes that each load GPT-2 (mapped or private) and run a forward pass"""
+    context = multiprocessing.get_context('spawn')
+    ready, release = context.Barrier(workers + 1), context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=_measure_worker, args=(mode, directory, ready, release, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    ready.wait()
+    samples = [results.get() for _ in processes]
+    release.set()
+    for process in processes:
+        process.join()
+
+    print(f"{mode}: {workers} workers")
+    for sample in samples:
+        print(f"  pid {sample['pid']:>7}  load {sample['load_seconds']:6.2f}s  RSS {sample['rss_mb']:7.1f} MB  "
+              f"PSS {sample['pss_mb']:7.1f} MB  private {sample['private_mb']:7.1f} MB")
+    print(f"  total PSS {sum(sample['pss_mb'] for sample in samples):.1f} MB")
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share one copy of the GPT-2 weights between worker processes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="write the memory-mappable weights file")
+    export.add_argument("--output", default=SHARED_WEIGHTS_DIR)
+    measure = subparsers.add_parser("measure", help="per-worker memory with private vs mapped weights")
+    measure.add_argument("--workers", type=int, default=4)
+    measure.add_argument("--directory", default=SHARED_WEIGHTS_DIR)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_weights(GPT2LMHeadModel.from_pretrained('gpt2'), args.output)
+    else:
+        measure_workers(args.workers, 'private', args.directory)
+        measure_workers(args.workers, 'mmap', args.directory)
@@ -0,0 +1,178 @@
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+_WORDS = ("the a of and to in is was for on that with as it by this are from at be an which or have "
+          "model system data result study analysis student education business technology war innovation "
+          "however therefore moreover significant important approach increase develop provide process").split()
+
+
+def current_rss_mb():
+    """Resident set size of this process right now (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def synthetic_corpus(documents=200, min_words=100, max_words=1500, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(documents):
+        sentences = []
+        for _ in range(rng.randint(min_words, max_words) // 15):
+            words = [rng.choice(_WORDS) for _ in range(rng.randint(5, 25))]
+            sentences.append(' '.join(words).capitalize() + rng.choice('..!?'))
+        texts.append(' '.join(sentences))
+    return texts
+
+
+def _top_allocators(baseline, limit):
+    snapshot = tracemalloc.take_snapshot()
+    return [{'location': str(stat.traceback[0]), 'size_diff_kb': round(stat.size_diff / 1024, 1),
+             'count_diff': stat.count_diff}
+            for stat in snapshot.compare_to(baseline, 'lineno')[:limit]]
+
+
+def soak(score, texts, duration, interval, output, trace_allocations=False, top_allocators=5):
+    """
+        Run score(text) over the texts in a loop for `duration` seconds and append one JSON line
+        per `interval` seconds with throughput, RSS and (optionally) the tracemalloc allocators
+        that grew the most since the first interval. Returns the list of samples
+    """
+    if trace_allocations:
+        tracemalloc.start(10)
+    baseline = None
+    samples = []
+    start = last = time.perf_counter()
+    documents = interval_documents = 0
+
+    with open(output, 'w') as file:
+        while last - start < duration:
+            score(texts[documents % len(texts)])
+            documents += 1
+            interval_documents += 1
+
+            now = time.perf_counter()
+            if now - last < interval:
+                continue
+            gc.collect()
+            sample = {
+                'elapsed_s': round(now - start, 2),
+                'documents': documents,
+                'docs_per_s': interval_documents / (now - last),
+                'rss_mb': current_rss_mb(),
+            }
+            if trace_allocations:
+                sample['traced_mb'] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+                if baseline is None:
+                    baseline = tracemalloc.take_snapshot()
+                else:
+                    sample['top_allocators'] = _top_allocators(baseline, top_allocators)
+            samples.append(sample)
+            file.write(json.dumps(sample) + '\n')
+            file.flush()
+            print(f"{sample['elapsed_s']:>8.1f}s  {documents:>7} docs  {sample['docs_per_s']:8.2f} docs/s  "
+                  f"RSS {sample['rss_mb']:8.1f} MB")
+            last = time.perf_counter()
+            interval_documents = 0
+
+    if trace_allocations:
+        tracemalloc.stop()
+    return samples
+
+
+def summarize(samples, warmup=1):
+    """RSS growth and throughput decay after the first `warmup` samples"""
+    steady = samples[warmup:] if len(samples) > warmup + 1 else samples
+    window = max(1, min(3, len(steady) // 3))
+    first_throughput = np.median([sample['docs_per_s'] for sample in steady[:window]])
+    last_throughput = np.median([sample['docs_per_s'] for sample in steady[-window:]])
+    return {
+        'samples': len(samples),
+        'documents': samples[-1]['documents'],
+        'rss_start_mb': steady[0]['rss_mb'],
+        'rss_end_mb': steady[-1]['rss_mb'],
+        'rss_growth_mb': steady[-1]['rss_mb'] - steady[0]['rss_mb'],
+        'mean_docs_per_s': float(np.mean([sample['docs_per_s'] for sample in steady])),
+        'throughput_decay': float(1 - last_throughput / first_throughput) if first_throughput else 0.0,
+    }
+
+
+def check_thresholds(summary, max_rss_growth_mb, max_throughput_decay):
+    failures = []
+    if summary['rss_growth_mb'] > max_rss_growth_mb:
+        failures.append(f"RSS grew {summary['rss_growth_mb']:.1f} MB (limit {max_rss_growth_mb} MB)")
+    if summary['throughput_decay'] > max_throughput_decay:
+        failures.append(f"throughput decayed {summary['throughput_decay']:.1%} (limit {max_throughput_decay:.0%})")
+    return failures
+
+
+def load_samples(path):
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def compare(paths):
+    """Print the summary of several soak time series side by side, e.g. from two releases"""
+    print(f"{'run':<30}{'docs/s':>10}{'RSS end':>10}{'growth':>10}{'decay':>9}")
+    for path in paths:
+        summary = summarize(load_samples(path))
+        print(f"{os.path.basename(path):<30}{summary['mean_docs_per_s']:>10.2f}{summary['rss_end_mb']:>9.1f}M"
+              f"{summary['rss_growth_mb']:>9.1f}M{summary['throughput_decay']:>9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Soak-test the scoring pipeline for memory growth and throughput decay")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run")
+    run.add_argument("--target", choices=["features", "perplexity"], default="features",
+                     help="score with get_text_features or calculate_perplexity only")
+    run.add_argument("--corpus", nargs='*', help="directories of real texts (synthetic texts by default)")
+    run.add_argument("--duration", type=float, default=600, help="seconds")
+    run.add_argument("--interval", type=float, default=10, help="seconds between samples")
+    run.add_argument("--output", default="soak_timeseries.jsonl")
+    run.add_argument("--tracemalloc", action="store_true", help="record top allocators (slows scoring down)")
+    run.add_argument("--max-rss-growth-mb", type=float, default=100)
+    run.add_argument("--max-throughput-decay", type=float, default=0.2)
+
+    comparison = subparsers.add_parser("compare")
+    comparison.add_argument("paths", nargs='+')
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args.paths)
+        return
+
+    import main as aux_function
+    from token_cache import read_corpus
+
+    texts = read_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    score = aux_function.get_text_features if args.target == "features" else aux_function.calculate_perplexity
+    samples = soak(score, texts, args.duration, args.interval, args.output, args.tracemalloc)
+    if not samples:
+        sys.exit("No samples recorded; increase --duration or lower --interval")
+
+    summary = summarize(samples)
+    print(f"\n{json.dumps(summary, indent=4)}")
+    failures = check_thresholds(summary, args.max_rss_growth_mb, args.max_throughput_decay)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print(f"Time series written to {args.output}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
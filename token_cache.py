@@ -0,0 +1,104 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from transformers import GPT2TokenizerFast
+
+# GPT-2's vocabulary (50,257 ids) fits in 16 bits
+TOKEN_DTYPE = np.uint16
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _cache_files(cache_path):
+    return cache_path + '.ids.npy', cache_path + '.offsets.npy', cache_path + '.hashes.json'
+
+
+def pretokenize_corpus(texts, cache_path, tokenizer=None, batch_size=256):
+    """
+        Tokenize the texts in batches with the fast GPT-2 tokenizer and store all token ids
+        in one flat array, with an offsets index and the content hash of every document
+    """
+    if tokenizer is None:
+        tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+
+    ids_file, offsets_file, hashes_file = _cache_files(cache_path)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    chunks = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        for i, ids in enumerate(tokenizer(batch)['input_ids']):
+            chunks.append(np.asarray(ids, dtype=TOKEN_DTYPE))
+            offsets[start + i + 1] = offsets[start + i] + len(ids)
+
+    token_ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=TOKEN_DTYPE)
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    np.save(ids_file, token_ids)
+    np.save(offsets_file, offsets)
+    with open(hashes_file, 'w') as file:
+        json.dump([text_hash(text) for text in texts], file)
+
+    print(f"Stored {len(token_ids)} tokens for {len(texts)} documents in {cache_path}")
+    return cache_path
+
+
+class TokenCache:
+    """Read-only, memory-mapped view of a corpus written by `pretokenize_corpus`"""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        ids_file, offsets_file, hashes_file = _cache_files(cache_path)
+        self.token_ids = np.load(ids_file, mmap_mode='r')
+        self.offsets = np.load(offsets_file, mmap_mode='r')
+        with open(hashes_file, 'r') as file:
+            self._index = {digest: i for i, digest in enumerate(json.load(file))}
+
+    def __reduce__(self):
+        # Worker processes re-open the files instead of receiving a copy of the arrays
+        return TokenCache, (self.cache_path,)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        # Slicing a memory-mapped array returns a view, no token ids are copied
+        return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, text):
+        """Token ids of the given text, or None when it was not pre-tokenized"""
+        i = self._index.get(text_hash(text))
+        return None if i is None else self[i]
+
+
+def load_token_cache(cache_path):
+    """Open the cache at cache_path, or return None when it has not been built"""
+    if not all(os.path.exists(file) for file in _cache_files(cache_path)):
+        return None
+    return TokenCache(cache_path)
+
+
+def read_corpus(directories):
+    texts = []
+    for directory in directories:
+        for filename in sorted(os.listdir(directory)):
+            file_path = os.path.join(directory, filename)
+            if os.path.isfile(file_path) and not filename.startswith('.'):
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+                    texts.append(file.read())
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-tokenize a corpus into a memory-mapped GPT-2 token cache")
+    parser.add_argument("cache_path", help="prefix of the cache files, e.g. cache/corpus")
+    parser.add_argument("directories", nargs='+')
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    pretokenize_corpus(read_corpus(args.directories), args.cache_path, batch_size=args.batch_size)
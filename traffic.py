@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+# Set to a JSONL path to record every classify_text / classify_texts request made through main
+TRAFFIC_LOG_ENV = "AI_DETECTION_TRAFFIC_LOG"
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TrafficRecorder:
+    """
+        Appends one JSON line per scoring request: when it arrived, which entry point, the SHA-1
+        and length of each text, the latency and the error if it failed. Texts themselves are
+        only stored with store_text, so logs of production traffic hold no essay content
+    """
+
+    def __init__(self, path, store_text=False):
+        self.path = path
+        self.store_text = store_text
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    @contextmanager
+    def record(self, entry, texts):
+        timestamp = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            record = {'timestamp': timestamp, 'entry': entry, 'text_sha1': [text_hash(text) for text in texts],
+                      'chars': [len(text) for text in texts], 'latency_s': time.perf_counter() - start,
+                      'error': error}
+            if self.store_text:
+                record['texts'] = list(texts)
+            with self._lock:
+                self._file.write(json.dumps(record) + '\n')
+                self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def recorder_from_env():
+    path = os.getenv(TRAFFIC_LOG_ENV)
+    return TrafficRecorder(path) if path else None
+
+
+def load_log(path):
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def synthetic_log(requests=500, rate=5.0, mean_chars=3000, batch_share=0.0, batch_size=16, seed=0):
+    """Poisson arrivals at `rate` requests/s with log-normal text lengths, optionally mixing in batch requests"""
+    rng = random.Random(seed)
+    log, timestamp = [], 0.0
+    for _ in range(requests):
+        timestamp += rng.expovariate(rate)
+        batch = rng.random() < batch_share
+        chars = [int(rng.lognormvariate(math.log(mean_chars), 0.6)) for _ in range(batch_size if batch else 1)]
+        log.append({'timestamp': timestamp, 'entry': 'classify_texts' if batch else 'classify_text',
+                    'text_sha1': [None] * len(chars), 'chars': chars})
+    return log
+
+
+def resolve_texts(log, corpus_texts, seed=0):
+    """
+        The text of every request: stored texts first, then corpus texts with the recorded hash,
+        otherwise a corpus text (or filler) cut to the recorded length so the load keeps its shape
+    """
+    from soak import synthetic_corpus
+
+    by_hash = {text_hash(text): text for text in corpus_texts}
+    pool = list(corpus_texts) or synthetic_corpus(64, 200, 3000, seed)
+    rng = random.Random(seed)
+    requests = []
+    for record in log:
+        if 'texts' in record:
+            requests.append(record['texts'])
+            continue
+        texts = []
+        for sha1, chars in zip(record['text_sha1'], record['chars']):
+            text = by_hash.get(sha1)
+            if text is None:
+                text = rng.choice(pool)
+                while len(text) < chars:
+                    text += ' ' + rng.choice(pool)
+                text = text[:chars]
+            texts.append(text)
+        requests.append(texts)
+    return requests
+
+
+def in_process_target(model_filename):
+    """Scores requests with main.classify_text / classify_texts on the loaded model artifact"""
+    import main as aux_function
+
+    model, feature_names = aux_function.load_model(model_filename)
+
+    def target(entry, texts):
+        if entry == 'classify_texts':
+            return aux_function.classify_texts(texts, model, feature_names)
+        return aux_function.classify_text(texts[0], model, feature_names)
+
+    return target
+
+
+def http_target(url, timeout=120):
+    """POSTs {"texts": [...]} (batches) or {"text": ...} to the serving endpoint at url"""
+    def target(entry, texts):
+        body = {'texts': texts} if entry == 'classify_texts' else {'text': texts[0]}
+        request = urllib.request.Request(url, json.dumps(body).encode('utf-8'),
+                                         {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+
+    return target
+
+
+def _timed(target, entry, texts, scheduled):
+    """Latency from the scheduled send time, so queueing behind slow requests is counted"""
+    try:
+        target(entry, texts)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return {'entry': entry, 'documents': len(texts), 'latency_s': time.perf_counter() - scheduled,
+            'finished': time.perf_counter(), 'error': error}
+
+
+def replay(log, requests, target, mode='open', rate=None, speed=1.0, concurrency=4, duration=None):
+    """
+        Drive target(entry, texts) with the logged requests. 'open' sends each request at its
+        recorded offset divided by speed (or at a fixed `rate` per second) whatever the scorer's
+        pace; 'closed' keeps `concurrency` requests in flight, sending the next as one finishes
+    """
+    results = []
+    start = time.perf_counter()
+    if mode == 'closed':
+        cursor = iter(range(len(log)))
+        lock = threading.Lock()
+
+        def client():
+            while duration is None or time.perf_counter() - start < duration:
+                with lock:
+                    index = next(cursor, None)
+                if index is None:
+                    return
+                result = _timed(target, log[index]['entry'], requests[index], time.perf_counter())
+                with lock:
+                    results.append(result)
+
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+    else:
+        first = log[0]['timestamp'] if log else 0.0
+        futures = []
+        with ThreadPoolExecutor(concurrency) as executor:
+            for index, record in enumerate(log):
+                offset = index / rate if rate else (record['timestamp'] - first) / speed
+                if duration is not None and offset > duration:
+                    break
+                scheduled = start + offset
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+                futures.append(executor.submit(_timed, target, record['entry'], requests[index], scheduled))
+        results = [future.result() for future in futures]
+
+    elapsed = max((result['finished'] for result in results), default=start) - start
+    return summarize(results, elapsed, mode)
+
+
+def summarize(results, elapsed, mode):
+    latencies = np.array([result['latency_s'] for result in results if result['error'] is None])
+    errors = sum(result['error'] is not None for result in results)
+    percentiles = np.percentile(latencies, [50, 90, 95, 99]) if len(latencies) else [math.nan] * 4
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'documents': sum(result['documents'] for result in results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'elapsed_s': elapsed,
+        'requests_per_s': len(results) / elapsed if elapsed else 0.0,
+        'documents_per_s': sum(result['documents'] for result in results) / elapsed if elapsed else 0.0,
+        'latency_p50_s': float(percentiles[0]),
+        'latency_p90_s': float(percentiles[1]),
+        'latency_p95_s': float(percentiles[2]),
+        'latency_p99_s': float(percentiles[3]),
+        'latency_max_s': float(latencies.max()) if len(latencies) else math.nan,
+        'first_errors': [result['error'] for result in results if result['error']][:5],
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['mode']} loop: {summary['requests']} requests ({summary['documents']} documents) in "
+          f"{summary['elapsed_s']:.1f}s = {summary['requests_per_s']:.2f} req/s, "
+          f"{summary['documents_per_s']:.2f} docs/s")
+    print(f"latency p50 {summary['latency_p50_s']:.3f}s  p90 {summary['latency_p90_s']:.3f}s  "
+          f"p95 {summary['latency_p95_s']:.3f}s  p99 {summary['latency_p99_s']:.3f}s  "
+          f"max {summary['latency_max_s']:.3f}s")
+    print(f"errors {summary['errors']} ({summary['error_rate']:.1%})")
+    for error in summary['first_errors']:
+        print(f"  {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded (or synthetic) scoring traffic against the scorer")
+    parser.add_argument("--log", help=f"JSONL written with {TRAFFIC_LOG_ENV} set; synthetic traffic if omitted")
+    parser.add_argument("--corpus", nargs='*', default=[], help="directories to find the logged texts in")
+    parser.add_argument("--synthetic-requests", type=int, default=200)
+    parser.add_argument("--url", help="POST to this serving endpoint instead of scoring in-process")
+    parser.add_argument("--model", default="ai_detection_model.pkl")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--rate", type=float, help="open loop: requests/s instead of the logged arrival times")
+    parser.add_argument("--speed", type=float, default=1.0, help="open loop: replay the logged timeline N times faster")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--output", help="write the summary as JSON, to compare releases")
+    args = parser.parse_args()
+
+    from token_cache import read_corpus
+
+    log = load_log(args.log) if args.log else synthetic_log(args.synthetic_requests, rate=args.rate or 5.0)
+    requests = resolve_texts(log, read_corpus(args.corpus) if args.corpus else [])
+    target = http_target(args.url) if args.url else in_process_target(args.model)
+    summary = replay(log, requests, target, args.mode, args.rate, args.speed, args.concurrency, args.duration)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()